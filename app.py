@@ -3,38 +3,76 @@ DrawTogether - Real-time Collaborative Drawing Board
 Production-Ready Version with Advanced Features
 """
 
-import json
 import uuid
 import asyncio
 import hashlib
+import hmac
 import base64
 import io
-from datetime import datetime
-from typing import Dict, List, Optional
-from dataclasses import dataclass, asdict, field
+import logging
+import time
+import zlib
+from typing import Callable, Deque, Dict, List, Optional, Set, Tuple, Union
+from dataclasses import dataclass, field
+from collections import OrderedDict, deque
+from itertools import islice
 
 from fastapi import FastAPI, WebSocket, WebSocketDisconnect, Request, HTTPException, Query
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
-from fastapi.responses import HTMLResponse, JSONResponse
+from fastapi.responses import HTMLResponse, ORJSONResponse, Response
 from contextlib import asynccontextmanager
 
 import aiosqlite
+import msgpack
+import orjson
+import zstandard
 
 # ============= Data Models =============
 
-@dataclass
+def decode_points(points) -> Union[List[Dict], bytes]:
+    """Accept stroke points as a list of {x, y} or in packed form: little-endian
+    int16 x0, y0 then a (dx, dy) pair per point, as raw bytes (MessagePack) or
+    base64 (JSON). Packed points are kept packed."""
+    if isinstance(points, str):
+        points = base64.b64decode(points, validate=True)
+    if isinstance(points, (bytes, bytearray)):
+        if len(points) % 4:
+            raise ValueError("packed points must be whole int16 (x, y) pairs")
+        return bytes(points)
+    return points
+
+def encode_points(points: Union[List[Dict], bytes]):
+    """JSON form of stroke points; packed points go out as base64"""
+    if isinstance(points, bytes):
+        return base64.b64encode(points).decode("ascii")
+    return points
+
+@dataclass(slots=True)
 class Stroke:
     id: str
     user_id: str
-    points: List[Dict]
+    points: Union[List[Dict], bytes]  # [{x, y}, ...] or packed int16 deltas
     color: str
     size: int
     layer_id: str
     timestamp: float
     tool: str = "brush"  # brush, eraser, line, rect, circle, text
+    
+    def to_dict(self) -> Dict:
+        # Unlike asdict(), points is passed by reference rather than deep-copied
+        return {
+            "id": self.id,
+            "user_id": self.user_id,
+            "points": encode_points(self.points),
+            "color": self.color,
+            "size": self.size,
+            "layer_id": self.layer_id,
+            "timestamp": self.timestamp,
+            "tool": self.tool
+        }
 
-@dataclass
+@dataclass(slots=True)
 class Layer:
     id: str
     name: str
@@ -42,82 +80,317 @@ class Layer:
     locked: bool = False
     opacity: float = 1.0
     order: int = 0
+    
+    def to_dict(self) -> Dict:
+        return {
+            "id": self.id,
+            "name": self.name,
+            "visible": self.visible,
+            "locked": self.locked,
+            "opacity": self.opacity,
+            "order": self.order
+        }
 
-@dataclass
+@dataclass(slots=True)
 class ChatMessage:
     id: str
     user_id: str
     nickname: str
     text: str
     timestamp: float
+    
+    def to_dict(self) -> Dict:
+        return {
+            "id": self.id,
+            "user_id": self.user_id,
+            "nickname": self.nickname,
+            "text": self.text,
+            "timestamp": self.timestamp
+        }
 
-@dataclass
+CHAT_HISTORY = 100  # messages kept per room
+CHAT_REPLAY = 50  # messages sent on join and persisted
+
+@dataclass(slots=True)
 class Room:
     id: str
     name: str
-    password_hash: Optional[str] = None
+    password_hash: Optional[bytes] = None  # BLAKE2b-256 digest
     layers: List[Layer] = field(default_factory=list)
-    strokes: List[Stroke] = field(default_factory=list)
-    chat_messages: List[ChatMessage] = field(default_factory=list)
+    strokes: Dict[str, Stroke] = field(default_factory=dict)  # by id, in drawing order
+    chat_messages: Deque[ChatMessage] = field(default_factory=lambda: deque(maxlen=CHAT_HISTORY))
     timer_end: Optional[float] = None
-    created_at: float = field(default_factory=lambda: datetime.now().timestamp())
+    created_at: float = field(default_factory=time.time)
     thumbnail: Optional[str] = None
+    
+    def recent_chat(self) -> List[ChatMessage]:
+        """The last CHAT_REPLAY messages, oldest first"""
+        skip = max(0, len(self.chat_messages) - CHAT_REPLAY)
+        return list(islice(self.chat_messages, skip, None))
 
-@dataclass 
+@dataclass(slots=True)
 class RoomStats:
     total_strokes: int
     total_users_joined: int
     active_users: int
     created_at: float
     last_activity: float
+    
+    def to_dict(self) -> Dict:
+        return {
+            "total_strokes": self.total_strokes,
+            "total_users_joined": self.total_users_joined,
+            "active_users": self.active_users,
+            "created_at": self.created_at,
+            "last_activity": self.last_activity
+        }
+
+@dataclass
+class StrokeLog:
+    """Revision counter over a room's drawing state (strokes and layers), so a
+    client reconnecting with the revision it last saw gets only what changed
+    since, and cached snapshots know whether they are current"""
+    # Revisions only mean something within one in-memory lifetime of the room
+    epoch: str = field(default_factory=lambda: uuid.uuid4().hex[:8])
+    rev: int = 0
+    stroke_rev: Dict[str, int] = field(default_factory=dict)
+    removed: Deque[Tuple[int, str]] = field(default_factory=deque)
+    # Removals up to this revision have been dropped from `removed`
+    floor: int = 0
+    
+    MAX_REMOVED = 1000
+    
+    def bump(self) -> int:
+        self.rev += 1
+        return self.rev
+    
+    def added(self, stroke_id: str):
+        self.stroke_rev[stroke_id] = self.bump()
+    
+    def dropped(self, stroke_id: str):
+        self.bump()
+        self.stroke_rev.pop(stroke_id, None)
+        self.removed.append((self.rev, stroke_id))
+        if len(self.removed) > self.MAX_REMOVED:
+            self.floor = self.removed.popleft()[0]
+    
+    def covers(self, epoch: str, since: int) -> bool:
+        return epoch == self.epoch and self.floor <= since <= self.rev
+    
+    def removed_since(self, since: int) -> List[str]:
+        ids = []
+        for rev, stroke_id in reversed(self.removed):
+            if rev <= since:
+                break
+            ids.append(stroke_id)
+        ids.reverse()
+        return ids
 
 # ============= Connection Manager =============
 
+_USER_COLORS = ('#FF6B6B', '#4ECDC4', '#45B7D1', '#96CEB4',
+                '#FFEAA7', '#DDA0DD', '#98D8C8', '#F7DC6F',
+                '#BB8FCE', '#85C1E9', '#F8B500', '#00CED1')
+
+def hash_password(password: str) -> bytes:
+    return hashlib.blake2b(password.encode(), digest_size=32).digest()
+
+class Outbox:
+    """Per-connection send queue drained by its own writer task, so a slow
+    client only ever delays its own frames"""
+
+    # Past this backlog, queued frames sharing a coalesce key are superseded
+    COALESCE_THRESHOLD = 32
+    MAX_BATCH = 64
+    # A client this far behind has stopped reading; it is cut off rather than
+    # holding every later room event in memory for it
+    MAX_QUEUE = 1024
+
+    def __init__(self, websocket: WebSocket, on_error: Optional[Callable[[], None]] = None):
+        self.websocket = websocket
+        self.on_error = on_error
+        self._queue: Deque[Tuple[Optional[str], bytes]] = deque()
+        self._wakeup = asyncio.Event()
+        self._idle = asyncio.Event()
+        self._idle.set()
+        self._task: Optional[asyncio.Task] = None
+        self._closer: Optional[asyncio.Task] = None
+        self._closed = False
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    def send(self, payload: bytes, coalesce_key: str = None):
+        """Queue a frame without waiting for the socket"""
+        if self._closed:
+            return
+        if coalesce_key is not None and len(self._queue) > self.COALESCE_THRESHOLD:
+            self._queue = deque(item for item in self._queue if item[0] != coalesce_key)
+        if len(self._queue) >= self.MAX_QUEUE:
+            self._overflow()
+            return
+        self._queue.append((coalesce_key, payload))
+        self._idle.clear()
+        self._wakeup.set()
+
+    def __len__(self):
+        return len(self._queue)
+
+    async def drain(self):
+        """Wait until every queued frame has been written or the outbox is shut"""
+        await self._idle.wait()
+
+    def close(self):
+        self._closed = True
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        self._queue.clear()
+        self._idle.set()
+
+    def _overflow(self):
+        self.close()
+        self._closer = asyncio.create_task(self._close_socket())
+        if self.on_error is not None:
+            # send() runs inside a broadcast over the room's outboxes, which
+            # on_error's disconnect would modify mid-iteration
+            asyncio.get_running_loop().call_soon(self.on_error)
+
+    async def _close_socket(self):
+        try:
+            await self.websocket.close(code=1013)  # try again later
+        except Exception:
+            pass
+
+    def _next_frame(self) -> bytes:
+        _, payload = self._queue.popleft()
+        if not (payload.startswith(b"{") and self._queue and self._queue[0][1].startswith(b"{")):
+            return payload
+        # JSON events that piled up behind the last send go out as one frame,
+        # spliced together without re-encoding
+        events = [payload]
+        while (self._queue and len(events) < self.MAX_BATCH
+               and self._queue[0][1].startswith(b"{")):
+            events.append(self._queue.popleft()[1])
+        return b'{"type":"batch","events":[' + b",".join(events) + b"]}"
+    
+    async def _run(self):
+        try:
+            while True:
+                await self._wakeup.wait()
+                while self._queue:
+                    await self.websocket.send_bytes(self._next_frame())
+                self._wakeup.clear()
+                self._idle.set()
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            self._queue.clear()
+            self._idle.set()
+            if self.on_error is not None:
+                self.on_error()
+
+
 class ConnectionManager:
+    CURSOR_INTERVAL = 1 / 30  # seconds between one user's cursor broadcasts
+    
     def __init__(self):
-        self.rooms: Dict[str, Dict[str, WebSocket]] = {}
+        self.rooms: Dict[str, Dict[str, Outbox]] = {}
         self.user_info: Dict[str, Dict] = {}
-        self.room_data: Dict[str, Room] = {}
+        # Least recently used rooms first; idle ones get evicted to the DB
+        self.room_data: "OrderedDict[str, Room]" = OrderedDict()
         self.room_stats: Dict[str, RoomStats] = {}
         self.user_colors: Dict[str, str] = {}
+        # Pre-serialized layers/strokes per room with the (epoch, rev) it was
+        # built at; rebuilt only once the room's StrokeLog has moved on
+        self.room_snapshot: Dict[str, Tuple[Tuple[str, int], bytes]] = {}
+        # Rooms mutated since the last autosave flush
+        self.dirty_rooms: Set[str] = set()
+        # Stroke rows still to be inserted/deleted by the next flush, per room
+        self.pending_strokes: Dict[str, Dict[str, Stroke]] = {}
+        self.removed_strokes: Dict[str, Set[str]] = {}
+        # Per room, each user's stroke ids in drawing order (their undo stack)
+        self.user_stroke_ids: Dict[str, Dict[str, List[str]]] = {}
+        # When each room's last user left
+        self.idle_since: Dict[str, float] = {}
+        # Connections per room still in accept(); pins the room against eviction
+        self.joining: Dict[str, int] = {}
+        self.stroke_logs: Dict[str, StrokeLog] = {}
+        # Each live stroke's encoded JSON, so snapshots are joined rather than
+        # re-encoding every stroke after each mutation
+        self.stroke_json: Dict[str, Dict[str, bytes]] = {}
+        # Per user: when their last cursor frame went out, and the newest one
+        # held back until their next slot
+        self.cursor_sent: Dict[str, float] = {}
+        self.cursor_pending: Dict[str, Tuple[str, bytes]] = {}
     
     def _get_user_color(self, user_id: str) -> str:
-        if user_id not in self.user_colors:
-            colors = ['#FF6B6B', '#4ECDC4', '#45B7D1', '#96CEB4', 
-                     '#FFEAA7', '#DDA0DD', '#98D8C8', '#F7DC6F',
-                     '#BB8FCE', '#85C1E9', '#F8B500', '#00CED1']
-            self.user_colors[user_id] = colors[len(self.user_colors) % len(colors)]
-        return self.user_colors[user_id]
-    
-    async def connect(self, websocket: WebSocket, room_id: str, user_id: str, nickname: str, password: str = None):
-        await websocket.accept()
+        color = self.user_colors.get(user_id)
+        if color is None:
+            color = self.user_colors[user_id] = _USER_COLORS[len(self.user_colors) % len(_USER_COLORS)]
+        return color
+    
+    def _check_password(self, room: Room, password: str) -> bool:
+        digest = hash_password(password)
+        if hmac.compare_digest(digest, room.password_hash):
+            return True
+        # Rooms protected before the switch to BLAKE2b hold a SHA-256 digest;
+        # upgrade them on the first correct password
+        if hmac.compare_digest(hashlib.sha256(password.encode()).digest(), room.password_hash):
+            room.password_hash = digest
+            self.dirty_rooms.add(room.id)
+            return True
+        return False
+    
+    async def connect(self, websocket: WebSocket, room_id: str, user_id: str, nickname: str,
+                      password: str = None, since: str = None, subprotocol: str = None):
+        # Evicting the room mid-accept would skip the password check below and
+        # recreate it empty; nothing awaits between here and registering the outbox
+        self.joining[room_id] = self.joining.get(room_id, 0) + 1
+        try:
+            await websocket.accept(subprotocol=subprotocol)
+        finally:
+            self.joining[room_id] -= 1
+            if not self.joining[room_id]:
+                del self.joining[room_id]
         
         # Check password if room exists and is protected
         if room_id in self.room_data:
             room = self.room_data[room_id]
             if room.password_hash:
-                if not password or hashlib.sha256(password.encode()).hexdigest() != room.password_hash:
-                    await websocket.send_json({"type": "error", "message": "Invalid password"})
+                if not password or not self._check_password(room, password):
+                    await websocket.send_bytes(orjson.dumps({"type": "error", "message": "Invalid password"}))
                     await websocket.close()
                     return False
         
         if room_id not in self.rooms:
             self.rooms[room_id] = {}
+        # Rooms restored from the DB are already in room_data; don't replace them
+        if room_id not in self.room_data:
             self.room_data[room_id] = Room(
                 id=room_id,
                 name=room_id,
                 layers=[Layer(id="layer_0", name="Background", order=0)],
-                password_hash=hashlib.sha256(password.encode()).hexdigest() if password else None
+                password_hash=hash_password(password) if password else None
             )
+            self.stroke_logs[room_id] = StrokeLog()
+            # Persist new rooms even if nobody draws, so an evicted room keeps its password
+            self.dirty_rooms.add(room_id)
+        if room_id not in self.room_stats:
             self.room_stats[room_id] = RoomStats(
-                total_strokes=0,
+                total_strokes=len(self.room_data[room_id].strokes),
                 total_users_joined=0,
                 active_users=0,
-                created_at=datetime.now().timestamp(),
-                last_activity=datetime.now().timestamp()
+                created_at=time.time(),
+                last_activity=time.time()
             )
         
-        self.rooms[room_id][user_id] = websocket
+        # Frames broadcast while the init state is in flight wait in the outbox
+        outbox = Outbox(websocket)
+        outbox.on_error = lambda: self._drop_outbox(room_id, user_id, outbox)
+        self.rooms[room_id][user_id] = outbox
+        self.idle_since.pop(room_id, None)
+        self.room_data.move_to_end(room_id)
         self.user_info[user_id] = {
             "nickname": nickname, 
             "room_id": room_id,
@@ -127,7 +400,41 @@ class ConnectionManager:
         # Update stats
         self.room_stats[room_id].total_users_joined += 1
         self.room_stats[room_id].active_users = len(self.rooms[room_id])
-        self.room_stats[room_id].last_activity = datetime.now().timestamp()
+        self.room_stats[room_id].last_activity = time.time()
+        
+        # Send current state to new user
+        room = self.room_data[room_id]
+        log = self._stroke_log(room_id)
+        room_info = {
+            "id": room.id,
+            "name": room.name,
+            "has_password": room.password_hash is not None,
+            # orjson encodes the dataclasses directly, same shape as to_dict()
+            "chat_messages": room.recent_chat(),
+            "timer_end": room.timer_end,
+            "epoch": log.epoch,
+            "rev": log.rev
+        }
+        delta = self.get_room_delta(room_id, since) if since else None
+        if delta is not None:
+            room_info.update(delta)
+            room_json = orjson.dumps(room_info)
+        else:
+            # Splice the cached layers/strokes object into the room object
+            room_json = orjson.dumps(room_info)[:-1] + b"," + self.get_room_snapshot(room_id)[1:]
+        message = orjson.dumps({
+            "type": "init",
+            "users": self.get_room_users(room_id),
+            "stats": self.room_stats[room_id].to_dict(),
+            "your_color": self.user_info[user_id]["color"]
+        })
+        try:
+            await websocket.send_bytes(b'{"room":' + room_json + b"," + message[1:])
+        except Exception:
+            # The outbox never started, so nothing else would unregister it
+            self._drop_outbox(room_id, user_id, outbox)
+            raise
+        outbox.start()
         
         # Notify others
         await self.broadcast(room_id, {
@@ -138,38 +445,121 @@ class ConnectionManager:
             "users": self.get_room_users(room_id)
         }, exclude=user_id)
         
-        # Send current state to new user
-        room = self.room_data[room_id]
-        await websocket.send_json({
-            "type": "init",
-            "room": {
-                "id": room.id,
-                "name": room.name,
-                "has_password": room.password_hash is not None,
-                "layers": [asdict(l) for l in room.layers],
-                "strokes": [asdict(s) for s in room.strokes],
-                "chat_messages": [asdict(m) for m in room.chat_messages[-50:]],  # Last 50 messages
-                "timer_end": room.timer_end
-            },
-            "users": self.get_room_users(room_id),
-            "stats": asdict(self.room_stats[room_id]),
-            "your_color": self.user_info[user_id]["color"]
-        })
-        
         return True
     
+    def get_room_snapshot(self, room_id: str) -> bytes:
+        """JSON object holding the room's layers and strokes, cached until the next mutation"""
+        log = self._stroke_log(room_id)
+        version = (log.epoch, log.rev)
+        cached = self.room_snapshot.get(room_id)
+        if cached is None or cached[0] != version:
+            room = self.room_data[room_id]
+            cached = self.room_snapshot[room_id] = (version, orjson.dumps({
+                "layers": [l.to_dict() for l in room.layers],
+                "strokes": [orjson.Fragment(self.encoded_stroke(room_id, s)) for s in room.strokes.values()]
+            }))
+        return cached[1]
+    
+    def encoded_stroke(self, room_id: str, stroke: Stroke) -> bytes:
+        """The stroke's JSON, encoded once and reused by snapshots, deltas and
+        broadcasts (embedded via orjson.Fragment instead of a to_dict() walk)"""
+        cache = self.stroke_json.setdefault(room_id, {})
+        encoded = cache.get(stroke.id)
+        if encoded is None:
+            encoded = cache[stroke.id] = orjson.dumps(stroke.to_dict())
+        return encoded
+    
+    def _stroke_log(self, room_id: str) -> StrokeLog:
+        if room_id not in self.stroke_logs:
+            self.stroke_logs[room_id] = StrokeLog()
+        return self.stroke_logs[room_id]
+    
+    def get_room_delta(self, room_id: str, since: str) -> Optional[Dict]:
+        """Layers plus the stroke changes after `since` ("epoch:rev"), or None
+        if the client needs the full snapshot instead"""
+        epoch, _, rev = since.partition(":")
+        try:
+            rev = int(rev)
+        except ValueError:
+            return None
+        log = self._stroke_log(room_id)
+        if not log.covers(epoch, rev):
+            return None
+        strokes = self.room_data[room_id].strokes
+        # Strokes are kept in the order they were (re)added, so the changed
+        # ones are a suffix
+        changed = []
+        for stroke_id in reversed(strokes):
+            if log.stroke_rev.get(stroke_id, 0) <= rev:
+                break
+            changed.append(orjson.Fragment(self.encoded_stroke(room_id, strokes[stroke_id])))
+        changed.reverse()
+        return {
+            "since": rev,
+            "layers": [l.to_dict() for l in self.room_data[room_id].layers],
+            "strokes": changed,
+            "removed_stroke_ids": log.removed_since(rev)
+        }
+    
     def disconnect(self, room_id: str, user_id: str):
         if room_id in self.rooms and user_id in self.rooms[room_id]:
-            del self.rooms[room_id][user_id]
+            self.rooms[room_id].pop(user_id).close()
+            self.cursor_sent.pop(user_id, None)
+            self.cursor_pending.pop(user_id, None)
             nickname = self.user_info.get(user_id, {}).get("nickname", "Unknown")
             del self.user_info[user_id]
             
             if room_id in self.room_stats:
                 self.room_stats[room_id].active_users = len(self.rooms.get(room_id, {}))
+            if not self.rooms[room_id]:
+                self.idle_since[room_id] = time.time()
+                if room_id in self.room_data:
+                    self.room_data.move_to_end(room_id)
             
             return nickname
         return None
     
+    def _drop_outbox(self, room_id: str, user_id: str, outbox: Outbox):
+        # A reconnect under the same user id may already have replaced it
+        if self.rooms.get(room_id, {}).get(user_id) is outbox:
+            nickname = self.disconnect(room_id, user_id)
+            # The endpoint finds the user already gone, so peers hear it here
+            self._enqueue(room_id, orjson.dumps({
+                "type": "user_left",
+                "user_id": user_id,
+                "nickname": nickname,
+                "users": self.get_room_users(room_id)
+            }))
+    
+    def has_peers(self, room_id: str) -> bool:
+        """Whether anyone besides the sender would receive a room broadcast"""
+        return len(self.rooms.get(room_id, ())) > 1
+    
+    def idle_rooms(self, max_idle: float) -> List[str]:
+        """Rooms that have had no users for at least `max_idle` seconds"""
+        cutoff = time.time() - max_idle
+        return [rid for rid, since in self.idle_since.items()
+                if since <= cutoff and not self.rooms.get(rid)]
+    
+    def overflow_rooms(self, max_rooms: int) -> List[str]:
+        """Least recently used empty rooms beyond the first `max_rooms` in memory"""
+        excess = len(self.room_data) - max_rooms
+        if excess <= 0:
+            return []
+        # Occupied rooms and rooms being joined are pinned; the rest go oldest first
+        return [rid for rid in self.room_data
+                if not self.rooms.get(rid) and rid not in self.joining][:excess]
+    
+    def evict_room(self, room_id: str) -> bool:
+        """Drop an empty room from memory; it must have been flushed first"""
+        if (self.rooms.get(room_id) or room_id in self.joining or room_id in self.dirty_rooms
+                or room_id in self.pending_strokes or room_id in self.removed_strokes):
+            return False
+        for store in (self.rooms, self.room_data, self.room_stats, self.room_snapshot,
+                      self.user_stroke_ids, self.idle_since, self.stroke_logs, self.stroke_json):
+            store.pop(room_id, None)
+        return True
+    
     def get_room_users(self, room_id: str) -> List[Dict]:
         users = []
         for uid in self.rooms.get(room_id, {}):
@@ -184,54 +574,159 @@ class ConnectionManager:
     async def broadcast(self, room_id: str, message: dict, exclude: str = None):
         if room_id not in self.rooms:
             return
-        disconnected = []
-        for user_id, ws in list(self.rooms[room_id].items()):
-            if user_id != exclude:
-                try:
-                    await ws.send_json(message)
-                except:
-                    disconnected.append(user_id)
-        
-        for uid in disconnected:
-            self.disconnect(room_id, uid)
+        await self.broadcast_bytes(room_id, orjson.dumps(message), exclude=exclude)
+    
+    async def broadcast_bytes(self, room_id: str, payload: bytes, exclude: str = None,
+                              coalesce_key: str = None):
+        """Queue an already-encoded frame for everyone in the room except `exclude`
+
+        Frames with the same `coalesce_key` (e.g. one user's cursor) replace
+        each other in a backed-up outbox instead of piling up.
+        """
+        self._enqueue(room_id, payload, exclude, coalesce_key)
+    
+    def _enqueue(self, room_id: str, payload: bytes, exclude: str = None, coalesce_key: str = None):
+        for uid, outbox in self.rooms.get(room_id, {}).items():
+            if uid != exclude:
+                outbox.send(payload, coalesce_key)
+    
+    def send_cursor(self, room_id: str, user_id: str, payload: bytes):
+        """Broadcast a user's cursor frame at most once per CURSOR_INTERVAL;
+        moves in between only replace the frame sent at the next slot"""
+        now = time.monotonic()
+        wait = self.cursor_sent.get(user_id, 0.0) + self.CURSOR_INTERVAL - now
+        if wait <= 0:
+            self.cursor_sent[user_id] = now
+            self._enqueue(room_id, payload, user_id, f"cursor:{user_id}")
+            return
+        if user_id not in self.cursor_pending:
+            asyncio.get_running_loop().call_later(wait, self._flush_cursor, user_id)
+        self.cursor_pending[user_id] = (room_id, payload)
+    
+    def _flush_cursor(self, user_id: str):
+        pending = self.cursor_pending.pop(user_id, None)
+        if pending is not None:
+            room_id, payload = pending
+            self.cursor_sent[user_id] = time.monotonic()
+            self._enqueue(room_id, payload, user_id, f"cursor:{user_id}")
+    
+    def restore_room(self, room: Room) -> bool:
+        """Install a room loaded from the DB, unless it is already in memory"""
+        # Two joins can both miss the room and load it; the copy the first one
+        # installed may already have new strokes, epoch and undo stacks
+        if room.id in self.room_data:
+            return False
+        self.room_data[room.id] = room
+        self.room_stats[room.id] = RoomStats(
+            total_strokes=len(room.strokes),
+            total_users_joined=0,
+            active_users=0,
+            created_at=room.created_at,
+            last_activity=time.time()
+        )
+        # Revisions from a previous lifetime of the room no longer apply
+        self.stroke_logs[room.id] = StrokeLog()
+        self.stroke_json.pop(room.id, None)
+        stacks = self.user_stroke_ids[room.id] = {}
+        for s in room.strokes.values():
+            stacks.setdefault(s.user_id, []).append(s.id)
+        # Nobody is in it until connect() registers them; if that join is
+        # rejected or drops, the room still ages out like any other empty one
+        if not self.rooms.get(room.id):
+            self.idle_since[room.id] = time.time()
+        return True
     
     def add_stroke(self, room_id: str, stroke: Stroke):
         if room_id in self.room_data:
-            self.room_data[room_id].strokes.append(stroke)
+            strokes = self.room_data[room_id].strokes
+            # A re-sent id (redo) moves to the end of the drawing order
+            strokes.pop(stroke.id, None)
+            strokes[stroke.id] = stroke
+            self.stroke_json.get(room_id, {}).pop(stroke.id, None)
+            self.user_stroke_ids.setdefault(room_id, {}).setdefault(stroke.user_id, []).append(stroke.id)
+            self.dirty_rooms.add(room_id)
+            self.pending_strokes.setdefault(room_id, {})[stroke.id] = stroke
+            self.removed_strokes.get(room_id, set()).discard(stroke.id)
+            self._stroke_log(room_id).added(stroke.id)
             if room_id in self.room_stats:
                 self.room_stats[room_id].total_strokes += 1
-                self.room_stats[room_id].last_activity = datetime.now().timestamp()
+                self.room_stats[room_id].last_activity = time.time()
     
     def remove_last_stroke(self, room_id: str, user_id: str) -> Optional[Stroke]:
         if room_id not in self.room_data:
             return None
+        stack = self.user_stroke_ids.get(room_id, {}).get(user_id)
         strokes = self.room_data[room_id].strokes
-        for i in range(len(strokes) - 1, -1, -1):
-            if strokes[i].user_id == user_id:
-                return strokes.pop(i)
+        while stack:
+            # Skip ids that no longer refer to a live stroke
+            stroke = strokes.pop(stack.pop(), None)
+            if stroke is not None:
+                self.dirty_rooms.add(room_id)
+                self._queue_stroke_removal(room_id, stroke.id)
+                return stroke
         return None
     
+    def _queue_stroke_removal(self, room_id: str, stroke_id: str):
+        self.pending_strokes.get(room_id, {}).pop(stroke_id, None)
+        self.removed_strokes.setdefault(room_id, set()).add(stroke_id)
+        self.stroke_json.get(room_id, {}).pop(stroke_id, None)
+        self._stroke_log(room_id).dropped(stroke_id)
+    
+    def pop_stroke_changes(self, room_id: str = None):
+        """Take the queued stroke inserts and deletions, for one room or all of them"""
+        room_ids = [room_id] if room_id is not None else list(self.pending_strokes.keys() | self.removed_strokes.keys())
+        added, removed = [], []
+        for rid in room_ids:
+            added.extend((rid, s) for s in self.pending_strokes.pop(rid, {}).values())
+            removed.extend((rid, sid) for sid in self.removed_strokes.pop(rid, set()))
+        return added, removed
+    
+    def requeue_stroke_changes(self, added: List[tuple], removed: List[tuple]):
+        """Put back changes from a failed flush, unless newer ones superseded them"""
+        for rid, stroke in added:
+            pending = self.pending_strokes.setdefault(rid, {})
+            if stroke.id not in pending and stroke.id not in self.removed_strokes.get(rid, set()):
+                pending[stroke.id] = stroke
+        for rid, sid in removed:
+            if sid not in self.pending_strokes.get(rid, {}):
+                self.removed_strokes.setdefault(rid, set()).add(sid)
+    
     def add_layer(self, room_id: str, layer: Layer):
         if room_id in self.room_data:
             self.room_data[room_id].layers.append(layer)
+            self._stroke_log(room_id).bump()
+            self.dirty_rooms.add(room_id)
     
     def clear_layer(self, room_id: str, layer_id: str):
         if room_id in self.room_data:
-            self.room_data[room_id].strokes = [
-                s for s in self.room_data[room_id].strokes 
-                if s.layer_id != layer_id
-            ]
+            kept = {}
+            cleared = set()
+            for sid, s in self.room_data[room_id].strokes.items():
+                if s.layer_id == layer_id:
+                    cleared.add(sid)
+                    self._queue_stroke_removal(room_id, sid)
+                else:
+                    kept[sid] = s
+            self.room_data[room_id].strokes = kept
+            if cleared:
+                for stack in self.user_stroke_ids.get(room_id, {}).values():
+                    stack[:] = [sid for sid in stack if sid not in cleared]
+            self.dirty_rooms.add(room_id)
     
     def add_chat_message(self, room_id: str, message: ChatMessage):
         if room_id in self.room_data:
+            # The deque drops the oldest message once CHAT_HISTORY is reached
             self.room_data[room_id].chat_messages.append(message)
-            # Keep only last 100 messages
-            if len(self.room_data[room_id].chat_messages) > 100:
-                self.room_data[room_id].chat_messages = self.room_data[room_id].chat_messages[-100:]
+            self.dirty_rooms.add(room_id)
+    
+    def set_thumbnail(self, room_id: str, thumbnail: str):
+        if room_id in self.room_data:
+            self.room_data[room_id].thumbnail = thumbnail
+            self.dirty_rooms.add(room_id)
     
     def set_timer(self, room_id: str, duration_seconds: int):
         if room_id in self.room_data:
-            self.room_data[room_id].timer_end = datetime.now().timestamp() + duration_seconds
+            self.room_data[room_id].timer_end = time.time() + duration_seconds
             return self.room_data[room_id].timer_end
         return None
     
@@ -243,123 +738,378 @@ class ConnectionManager:
 
 DB_PATH = "drawings.db"
 
+# Single long-lived connection opened by init_db(); opening one per query
+# spins up a fresh aiosqlite thread and journal setup on every call
+db_conn: Optional[aiosqlite.Connection] = None
+# SQLite has a single writer; background flushes and request handlers share
+# db_conn, so writes are serialized to keep their transactions apart
+db_lock: Optional[asyncio.Lock] = None
+# list_rooms() result, dropped whenever a room row is written
+_rooms_listing: Optional[List[Dict]] = None
+# Encoded /api/gallery body, dropped whenever a gallery row is written
+_gallery_listing: Optional[bytes] = None
+
 async def init_db():
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute("""
-            CREATE TABLE IF NOT EXISTS rooms (
-                id TEXT PRIMARY KEY,
-                name TEXT,
-                data TEXT,
-                thumbnail TEXT,
-                password_hash TEXT,
-                created_at REAL,
-                updated_at REAL
-            )
-        """)
-        await db.execute("""
-            CREATE TABLE IF NOT EXISTS gallery (
-                id TEXT PRIMARY KEY,
-                room_id TEXT,
-                title TEXT,
-                author TEXT,
-                image_data TEXT,
-                likes INTEGER DEFAULT 0,
-                created_at REAL
-            )
-        """)
-        await db.commit()
+    global db_conn, db_lock, _rooms_listing, _gallery_listing
+    _rooms_listing = None
+    _gallery_listing = None
+    if db_conn is None:
+        db_conn = await aiosqlite.connect(DB_PATH)
+        db_lock = asyncio.Lock()
+        await db_conn.execute("PRAGMA journal_mode=WAL")
+        await db_conn.execute("PRAGMA synchronous=NORMAL")
+        await db_conn.execute("PRAGMA temp_store=MEMORY")
+        # 64 MiB page cache, and reads served straight from a 256 MiB mapping
+        await db_conn.execute("PRAGMA cache_size=-65536")
+        await db_conn.execute("PRAGMA mmap_size=268435456")
+    await db_conn.execute("""
+        CREATE TABLE IF NOT EXISTS rooms (
+            id TEXT PRIMARY KEY,
+            name TEXT,
+            data BLOB,
+            thumbnail TEXT,
+            password_hash BLOB,
+            created_at REAL,
+            updated_at REAL
+        )
+    """)
+    # Databases from the first version only had (id, name, data)
+    cursor = await db_conn.execute("PRAGMA table_info(rooms)")
+    columns = {row[1] for row in await cursor.fetchall()}
+    for column, kind in (("thumbnail", "TEXT"), ("password_hash", "BLOB"),
+                         ("created_at", "REAL"), ("updated_at", "REAL")):
+        if column not in columns:
+            await db_conn.execute(f"ALTER TABLE rooms ADD COLUMN {column} {kind}")
+    await db_conn.execute("""
+        CREATE TABLE IF NOT EXISTS strokes (
+            room_id TEXT,
+            id TEXT,
+            user_id TEXT,
+            layer_id TEXT,
+            color TEXT,
+            size INTEGER,
+            points BLOB,
+            tool TEXT,
+            ts REAL,
+            PRIMARY KEY (room_id, id)
+        )
+    """)
+    await db_conn.execute("CREATE INDEX IF NOT EXISTS ix_strokes_room_ts ON strokes (room_id, ts)")
+    await db_conn.execute("""
+        CREATE TABLE IF NOT EXISTS gallery (
+            id TEXT PRIMARY KEY,
+            room_id TEXT,
+            title TEXT,
+            author TEXT,
+            image_data BLOB,  -- PNG bytes; older rows hold a base64 data URL
+            likes INTEGER DEFAULT 0,
+            created_at REAL
+        )
+    """)
+    await db_conn.commit()
+
+@asynccontextmanager
+async def write_transaction():
+    """Serialize a write against other writers and run it as one transaction"""
+    async with db_lock:
+        await db_conn.execute("BEGIN")
+        try:
+            yield
+            await db_conn.commit()
+        except BaseException:
+            await db_conn.rollback()
+            raise
+
+# Stroke JSON compresses several-fold; a zstd frame's magic number tells these
+# blobs apart from the plain JSON written by older versions
+_ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+_zstd_compressor = zstandard.ZstdCompressor(level=3)
+_zstd_decompressor = zstandard.ZstdDecompressor()
+
+def _pack_blob(obj) -> bytes:
+    raw = orjson.dumps(obj)
+    packed = _zstd_compressor.compress(raw)
+    # Tiny payloads can come out larger than they went in
+    return packed if len(packed) < len(raw) else raw
+
+def _unpack_blob(blob):
+    if isinstance(blob, bytes) and blob.startswith(_ZSTD_MAGIC):
+        blob = _zstd_decompressor.decompress(blob)
+    return orjson.loads(blob)
+
+# Packed points are stored as-is behind a tag byte that neither JSON nor a
+# zstd frame can start with; base64 would grow them by a third
+_PACKED_POINTS = b"\x01"
+
+def _pack_points(points: Union[List[Dict], bytes]) -> bytes:
+    if isinstance(points, bytes):
+        return _PACKED_POINTS + points
+    return _pack_blob(points)
+
+def _unpack_points(blob) -> Union[List[Dict], bytes]:
+    if isinstance(blob, bytes) and blob.startswith(_PACKED_POINTS):
+        return blob[1:]
+    # Rows written before the tag held packed points as a base64 string
+    return decode_points(_unpack_blob(blob))
+
+async def close_db():
+    global db_conn
+    if db_conn is not None:
+        await db_conn.close()
+        db_conn = None
+
+async def _write_room(room: Room):
+    # Strokes live in their own table and are written incrementally
+    data = _pack_blob({
+        "layers": [l.to_dict() for l in room.layers],
+        "chat_messages": room.recent_chat()
+    })
+    await db_conn.execute("""
+        INSERT OR REPLACE INTO rooms (id, name, data, thumbnail, password_hash, created_at, updated_at)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+    """, (room.id, room.name, data, room.thumbnail, room.password_hash, 
+          room.created_at, time.time()))
 
 async def save_room(room: Room):
-    async with aiosqlite.connect(DB_PATH) as db:
-        data = json.dumps({
-            "layers": [asdict(l) for l in room.layers],
-            "strokes": [asdict(s) for s in room.strokes],
-            "chat_messages": [asdict(m) for m in room.chat_messages[-50:]]
-        })
-        await db.execute("""
-            INSERT OR REPLACE INTO rooms (id, name, data, thumbnail, password_hash, created_at, updated_at)
-            VALUES (?, ?, ?, ?, ?, ?, ?)
-        """, (room.id, room.name, data, room.thumbnail, room.password_hash, 
-              room.created_at, datetime.now().timestamp()))
-        await db.commit()
+    await save_rooms([room])
+
+async def save_rooms(rooms: List[Room]):
+    """Write several rooms in a single transaction"""
+    global _rooms_listing
+    async with write_transaction():
+        for room in rooms:
+            await _write_room(room)
+    _rooms_listing = None
+
+async def _insert_strokes(rows: List[tuple]):
+    await db_conn.executemany("""
+        INSERT OR REPLACE INTO strokes (room_id, id, user_id, layer_id, color, size, points, tool, ts)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+    """, rows)
+
+def _stroke_row(room_id: str, s: Stroke) -> tuple:
+    return (room_id, s.id, s.user_id, s.layer_id, s.color, s.size,
+            _pack_points(s.points), s.tool, s.timestamp)
+
+async def save_stroke_changes(added: List[tuple], removed: List[tuple]):
+    """Apply queued (room_id, Stroke) inserts and (room_id, stroke_id) deletions"""
+    if not added and not removed:
+        return
+    # One transaction per batch instead of one per stroke
+    async with write_transaction():
+        await db_conn.executemany("DELETE FROM strokes WHERE room_id = ? AND id = ?", removed)
+        await _insert_strokes([_stroke_row(rid, s) for rid, s in added])
+
+async def load_strokes(room_id: str) -> List[Stroke]:
+    cursor = await db_conn.execute("""
+        SELECT id, user_id, points, color, size, layer_id, ts, tool
+        FROM strokes WHERE room_id = ? ORDER BY ts
+    """, (room_id,))
+    rows = await cursor.fetchall()
+    return [Stroke(
+        id=r[0],
+        user_id=r[1],
+        points=_unpack_points(r[2]),
+        color=r[3],
+        size=r[4],
+        layer_id=r[5],
+        timestamp=r[6],
+        tool=r[7]
+    ) for r in rows]
+
+def _password_digest(stored) -> Optional[bytes]:
+    # Older rows hold the digest as a hex string
+    return bytes.fromhex(stored) if isinstance(stored, str) else stored
 
 async def load_room(room_id: str) -> Optional[Room]:
-    async with aiosqlite.connect(DB_PATH) as db:
-        # Use SELECT * for compatibility with old DB schema
-        cursor = await db.execute("SELECT * FROM rooms WHERE id = ?", (room_id,))
-        row = await cursor.fetchone()
-        if row:
-            # Handle both old (3-column) and new (7-column) schema
-            data = {}
-            if len(row) >= 3 and row[2]:
-                data = json.loads(row[2])
-            
-            return Room(
-                id=row[0],
-                name=row[1] if len(row) > 1 else room_id,
-                layers=[Layer(**l) for l in data.get("layers", [{"id": "layer_0", "name": "Background", "visible": True, "order": 0}])],
-                strokes=[Stroke(**s) for s in data.get("strokes", [])],
-                chat_messages=[ChatMessage(**m) for m in data.get("chat_messages", [])],
-                thumbnail=row[3] if len(row) > 3 else None,
-                password_hash=row[4] if len(row) > 4 else None,
-                created_at=row[5] if len(row) > 5 else datetime.now().timestamp()
-            )
-        return None
+    cursor = await db_conn.execute(
+        "SELECT name, data, thumbnail, password_hash, created_at FROM rooms WHERE id = ?", (room_id,)
+    )
+    row = await cursor.fetchone()
+    if row:
+        name, blob, thumbnail, password_hash, created_at = row
+        data = _unpack_blob(blob) if blob else {}
+        
+        strokes = await load_strokes(room_id)
+        if not strokes and data.get("strokes"):
+            # Rooms saved before the strokes table kept them in the JSON blob
+            strokes = [Stroke(**s) for s in data["strokes"]]
+            async with write_transaction():
+                await _insert_strokes([_stroke_row(room_id, s) for s in strokes])
+        
+        return Room(
+            id=room_id,
+            name=name or room_id,
+            layers=[Layer(**l) for l in data.get("layers", [{"id": "layer_0", "name": "Background", "visible": True, "order": 0}])],
+            strokes={s.id: s for s in strokes},
+            chat_messages=deque((ChatMessage(**m) for m in data.get("chat_messages", [])), maxlen=CHAT_HISTORY),
+            thumbnail=thumbnail,
+            password_hash=_password_digest(password_hash),
+            # Columns added by init_db's migration are NULL on old rows
+            created_at=created_at or time.time()
+        )
+    return None
 
 async def list_rooms() -> List[Dict]:
-    async with aiosqlite.connect(DB_PATH) as db:
-        cursor = await db.execute(
-            "SELECT id, name, thumbnail, password_hash, created_at, updated_at FROM rooms ORDER BY updated_at DESC LIMIT 20"
-        )
-        rows = await cursor.fetchall()
-        return [{
-            "id": r[0], 
-            "name": r[1], 
-            "thumbnail": r[2],
-            "has_password": r[3] is not None,
-            "created_at": r[4], 
-            "updated_at": r[5]
-        } for r in rows]
+    """The 20 most recently updated rooms, served from memory until one is saved"""
+    global _rooms_listing
+    if _rooms_listing is None:
+        _rooms_listing = await _query_rooms()
+    return _rooms_listing
+
+async def _query_rooms() -> List[Dict]:
+    cursor = await db_conn.execute(
+        "SELECT id, name, thumbnail, password_hash, created_at, updated_at FROM rooms ORDER BY updated_at DESC LIMIT 20"
+    )
+    rows = await cursor.fetchall()
+    return [{
+        "id": r[0], 
+        "name": r[1], 
+        "thumbnail": r[2],
+        "has_password": r[3] is not None,
+        "created_at": r[4], 
+        "updated_at": r[5]
+    } for r in rows]
+
+_PNG_DATA_URL_PREFIX = "data:image/png;base64,"
+
+def _data_url_bytes(data_url: str) -> bytes:
+    """Raw bytes of a `data:image/png;base64,...` URL; ValueError if it isn't one"""
+    if not isinstance(data_url, str) or not data_url.startswith(_PNG_DATA_URL_PREFIX):
+        raise ValueError("expected a base64 PNG data URL")
+    return base64.b64decode(data_url[len(_PNG_DATA_URL_PREFIX):], validate=True)
 
 async def save_to_gallery(room_id: str, title: str, author: str, image_data: str) -> str:
+    global _gallery_listing
+    # Decoded up front so a bad image is rejected before the write starts
+    image = _data_url_bytes(image_data)
     gallery_id = str(uuid.uuid4())
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute("""
+    async with write_transaction():
+        await db_conn.execute("""
             INSERT INTO gallery (id, room_id, title, author, image_data, created_at)
             VALUES (?, ?, ?, ?, ?, ?)
-        """, (gallery_id, room_id, title, author, image_data, datetime.now().timestamp()))
-        await db.commit()
+        """, (gallery_id, room_id, title, author, image, time.time()))
+    _gallery_listing = None
     return gallery_id
 
 async def get_gallery() -> List[Dict]:
-    async with aiosqlite.connect(DB_PATH) as db:
-        cursor = await db.execute(
-            "SELECT id, room_id, title, author, image_data, likes, created_at FROM gallery ORDER BY created_at DESC LIMIT 50"
-        )
-        rows = await cursor.fetchall()
-        return [{
-            "id": r[0],
-            "room_id": r[1],
-            "title": r[2],
-            "author": r[3],
-            "image_data": r[4],
-            "likes": r[5],
-            "created_at": r[6]
-        } for r in rows]
+    # Images are fetched separately so the listing stays a few hundred bytes per item
+    cursor = await db_conn.execute(
+        "SELECT id, room_id, title, author, likes, created_at FROM gallery ORDER BY created_at DESC LIMIT 50"
+    )
+    rows = await cursor.fetchall()
+    return [{
+        "id": r[0],
+        "room_id": r[1],
+        "title": r[2],
+        "author": r[3],
+        "image_url": f"/api/gallery/{r[0]}/image",
+        "likes": r[4],
+        "created_at": r[5]
+    } for r in rows]
+
+async def gallery_listing() -> bytes:
+    """get_gallery() as JSON, served from memory until an item is posted or liked"""
+    global _gallery_listing
+    if _gallery_listing is None:
+        _gallery_listing = orjson.dumps(await get_gallery())
+    return _gallery_listing
+
+async def get_gallery_image(gallery_id: str) -> Optional[bytes]:
+    cursor = await db_conn.execute("SELECT image_data FROM gallery WHERE id = ?", (gallery_id,))
+    row = await cursor.fetchone()
+    if row is None:
+        return None
+    image = row[0]
+    if isinstance(image, str):
+        # Older rows were stored unchecked; one that isn't a PNG can't be served as one
+        try:
+            return _data_url_bytes(image)
+        except ValueError:
+            return None
+    return image
 
 async def like_gallery_item(gallery_id: str):
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute("UPDATE gallery SET likes = likes + 1 WHERE id = ?", (gallery_id,))
-        await db.commit()
+    global _gallery_listing
+    async with write_transaction():
+        await db_conn.execute("UPDATE gallery SET likes = likes + 1 WHERE id = ?", (gallery_id,))
+    _gallery_listing = None
 
 # ============= FastAPI App =============
 
+AUTOSAVE_INTERVAL = 2.0  # seconds
+STROKE_FLUSH_INTERVAL = 0.1  # seconds
+EVICTION_INTERVAL = 30.0  # seconds
+ROOM_IDLE_TTL = 300.0  # seconds a room stays in memory after its last user leaves
+MAX_HOT_ROOMS = 64  # empty rooms beyond this many in memory are evicted early
+ROOMS_BODY_TTL = 1.0  # seconds the encoded /api/rooms body may lag joins/leaves
+# Clients offering this subprotocol send MessagePack frames instead of JSON text
+MSGPACK_SUBPROTOCOL = "msgpack.dt"
+
+async def flush_strokes():
+    """Write the queued stroke inserts/deletions for all rooms in one batch"""
+    added, removed = manager.pop_stroke_changes()
+    try:
+        await save_stroke_changes(added, removed)
+    except Exception:
+        # Retry on the next tick rather than losing the changes
+        manager.requeue_stroke_changes(added, removed)
+        raise
+
+async def flush_dirty_rooms():
+    """Persist every room mutated since the last flush"""
+    room_ids = [rid for rid in manager.dirty_rooms if rid in manager.room_data]
+    manager.dirty_rooms.clear()
+    if room_ids:
+        try:
+            await save_rooms([manager.room_data[rid] for rid in room_ids])
+        except Exception:
+            manager.dirty_rooms.update(room_ids)
+            raise
+    await flush_strokes()
+
+async def evict_idle_rooms():
+    """Flush and unload rooms nobody has been in for ROOM_IDLE_TTL, and the
+    least recently used empty ones while more than MAX_HOT_ROOMS are loaded"""
+    idle = manager.idle_rooms(ROOM_IDLE_TTL)
+    idle += [rid for rid in manager.overflow_rooms(MAX_HOT_ROOMS) if rid not in idle]
+    if not idle:
+        return
+    await flush_dirty_rooms()
+    for room_id in idle:
+        manager.evict_room(room_id)
+
+logger = logging.getLogger(__name__)
+
+async def _run_periodically(interval: float, flush):
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await flush()
+        except Exception:
+            # Keep the loop alive; the flush helpers requeue what they couldn't write
+            logger.exception("%s failed, retrying in %.1fs", flush.__name__, interval)
+
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     await init_db()
+    tasks = [
+        asyncio.create_task(_run_periodically(AUTOSAVE_INTERVAL, flush_dirty_rooms)),
+        asyncio.create_task(_run_periodically(STROKE_FLUSH_INTERVAL, flush_strokes)),
+        asyncio.create_task(_run_periodically(EVICTION_INTERVAL, evict_idle_rooms)),
+    ]
     yield
+    for task in tasks:
+        task.cancel()
+    # Let a flush that was mid-write finish unwinding before the final one
+    await asyncio.gather(*tasks, return_exceptions=True)
+    try:
+        await flush_dirty_rooms()
+    finally:
+        await close_db()
 
-app = FastAPI(title="DrawTogether - Collaborative Drawing Board", lifespan=lifespan)
+app = FastAPI(title="DrawTogether - Collaborative Drawing Board", lifespan=lifespan,
+              default_response_class=ORJSONResponse)
 app.mount("/static", StaticFiles(directory="static"), name="static")
 templates = Jinja2Templates(directory="templates")
 
@@ -391,55 +1141,93 @@ async def room_page(request: Request, room_id: str):
 async def gallery_page(request: Request):
     return templates.TemplateResponse("gallery.html", {"request": request})
 
+# (encoded at, listing it was built from, body, etag)
+_rooms_body: Optional[Tuple[float, List[Dict], bytes, str]] = None
+
 @app.get("/api/rooms")
-async def get_rooms():
-    rooms = await list_rooms()
-    # Add active user counts
-    for room in rooms:
-        room["active_users"] = len(manager.rooms.get(room["id"], {}))
-    return JSONResponse(rooms)
+async def get_rooms(request: Request):
+    global _rooms_body
+    listing = await list_rooms()
+    # A save replaces the listing object, so a new listing always re-encodes;
+    # otherwise only the active user counts can be stale, and only briefly
+    if (_rooms_body is None or _rooms_body[1] is not listing
+            or time.time() - _rooms_body[0] >= ROOMS_BODY_TTL):
+        # Add active user counts; the listing itself is cached, so don't mutate it
+        body = orjson.dumps([
+            {**room, "active_users": len(manager.rooms.get(room["id"], {}))}
+            for room in listing
+        ])
+        # The body changes with saves and with joins/leaves, so tag the body itself
+        _rooms_body = (time.time(), listing, body, f'"{zlib.crc32(body):08x}"')
+    _, _, body, etag = _rooms_body
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers={"ETag": etag})
+    return Response(body, media_type="application/json", headers={"ETag": etag})
 
 @app.get("/api/gallery")
 async def get_gallery_api():
-    gallery = await get_gallery()
-    return JSONResponse(gallery)
+    return Response(await gallery_listing(), media_type="application/json")
 
 @app.post("/api/gallery")
 async def post_to_gallery(request: Request):
     data = await request.json()
-    gallery_id = await save_to_gallery(
-        data["room_id"],
-        data["title"],
-        data["author"],
-        data["image_data"]
-    )
-    return JSONResponse({"id": gallery_id})
+    try:
+        gallery_id = await save_to_gallery(
+            data["room_id"],
+            data["title"],
+            data["author"],
+            data["image_data"]
+        )
+    except ValueError:
+        return ORJSONResponse({"error": "image_data must be a base64 PNG data URL"}, status_code=400)
+    return ORJSONResponse({"id": gallery_id})
+
+@app.get("/api/gallery/{gallery_id}/image")
+async def get_gallery_image_api(gallery_id: str):
+    image = await get_gallery_image(gallery_id)
+    if image is None:
+        return ORJSONResponse({"error": "Image not found"}, status_code=404)
+    # Gallery entries are never edited, so browsers can keep the image
+    return Response(image, media_type="image/png",
+                    headers={"Cache-Control": "public, max-age=31536000, immutable"})
 
 @app.post("/api/gallery/{gallery_id}/like")
 async def like_gallery(gallery_id: str):
     await like_gallery_item(gallery_id)
-    return JSONResponse({"status": "liked"})
+    return ORJSONResponse({"status": "liked"})
 
 @app.post("/api/rooms/{room_id}/save")
 async def save_room_endpoint(room_id: str):
     if room_id in manager.room_data:
-        await save_room(manager.room_data[room_id])
+        manager.dirty_rooms.discard(room_id)
+        try:
+            await save_room(manager.room_data[room_id])
+        except Exception:
+            # Leave it for the autosave to retry, as flush_dirty_rooms does
+            manager.dirty_rooms.add(room_id)
+            raise
+        added, removed = manager.pop_stroke_changes(room_id)
+        try:
+            await save_stroke_changes(added, removed)
+        except Exception:
+            manager.requeue_stroke_changes(added, removed)
+            raise
         return {"status": "saved"}
-    return JSONResponse({"error": "Room not found"}, status_code=404)
+    return ORJSONResponse({"error": "Room not found"}, status_code=404)
 
 @app.get("/api/rooms/{room_id}/stats")
 async def get_room_stats(room_id: str):
     if room_id in manager.room_stats:
-        return JSONResponse(asdict(manager.room_stats[room_id]))
-    return JSONResponse({"error": "Room not found"}, status_code=404)
+        return ORJSONResponse(manager.room_stats[room_id].to_dict())
+    return ORJSONResponse({"error": "Room not found"}, status_code=404)
 
 @app.get("/api/stickers")
 async def get_stickers():
-    return JSONResponse(STICKERS)
+    return ORJSONResponse(STICKERS)
 
 @app.get("/api/shortcuts")
 async def get_shortcuts():
-    return JSONResponse([
+    return ORJSONResponse([
         {"key": "Ctrl+Z", "action": "Undo"},
         {"key": "Ctrl+Y", "action": "Redo"},
         {"key": "B", "action": "Brush tool"},
@@ -462,29 +1250,39 @@ async def websocket_endpoint(websocket: WebSocket, room_id: str):
     user_id = websocket.query_params.get("user_id", str(uuid.uuid4()))
     nickname = websocket.query_params.get("nickname", "Anonymous")
     password = websocket.query_params.get("password", "")
+    # "epoch:rev" from the last init, on reconnect
+    since = websocket.query_params.get("since")
     
-    # Try to load existing room from DB
+    # Try to load existing room from DB; restore_room() keeps the copy if a
+    # concurrent join loaded it while this one was waiting on the query
     if room_id not in manager.room_data:
         saved_room = await load_room(room_id)
         if saved_room:
-            manager.room_data[room_id] = saved_room
-            manager.room_stats[room_id] = RoomStats(
-                total_strokes=len(saved_room.strokes),
-                total_users_joined=0,
-                active_users=0,
-                created_at=saved_room.created_at,
-                last_activity=datetime.now().timestamp()
-            )
+            manager.restore_room(saved_room)
     
-    connected = await manager.connect(websocket, room_id, user_id, nickname, password if password else None)
+    binary = MSGPACK_SUBPROTOCOL in websocket.scope.get("subprotocols", [])
+    
+    connected = await manager.connect(websocket, room_id, user_id, nickname, password if password else None,
+                                      since, subprotocol=MSGPACK_SUBPROTOCOL if binary else None)
     if not connected:
         return
     
     try:
         while True:
-            data = await websocket.receive_json()
-            await handle_message(room_id, user_id, nickname, data)
+            frame = await (websocket.receive_bytes() if binary else websocket.receive_text())
+            try:
+                # receive_json() would go through the stdlib json module
+                data = msgpack.unpackb(frame) if binary else orjson.loads(frame)
+                if isinstance(data, dict):
+                    await handle_message(room_id, user_id, nickname, data)
+            except (KeyError, TypeError, ValueError):
+                # A malformed frame is dropped; it shouldn't cost the connection
+                continue
     except WebSocketDisconnect:
+        pass
+    finally:
+        # Whatever ended the loop, the user must leave the room, or it stays
+        # pinned against eviction and counted in the lobby
         nickname = manager.disconnect(room_id, user_id)
         if nickname:
             await manager.broadcast(room_id, {
@@ -493,9 +1291,14 @@ async def websocket_endpoint(websocket: WebSocket, room_id: str):
                 "nickname": nickname,
                 "users": manager.get_room_users(room_id)
             })
-        # Auto-save on disconnect
-        if room_id in manager.room_data:
-            await save_room(manager.room_data[room_id])
+
+# Envelope for cursor broadcasts, refilled and encoded in place rather than
+# building a new dict per frame. Encoding never awaits, so sharing it between
+# connections on the one event loop is safe.
+_cursor_envelope = {"t": "c", "u": None, "x": 0, "y": 0}
+# Packer keeps its internal buffer between calls, unlike msgpack.packb
+_cursor_packer = msgpack.Packer()
+
 
 async def handle_message(room_id: str, user_id: str, nickname: str, data: dict):
     msg_type = data.get("type")
@@ -504,18 +1307,19 @@ async def handle_message(room_id: str, user_id: str, nickname: str, data: dict):
         stroke = Stroke(
             id=data.get("id", str(uuid.uuid4())),
             user_id=user_id,
-            points=data["points"],
+            points=decode_points(data["points"]),
             color=data["color"],
             size=data["size"],
             layer_id=data.get("layer_id", "layer_0"),
-            timestamp=datetime.now().timestamp(),
+            timestamp=time.time(),
             tool=data.get("tool", "brush")
         )
         manager.add_stroke(room_id, stroke)
-        await manager.broadcast(room_id, {
-            "type": "stroke",
-            "stroke": asdict(stroke)
-        }, exclude=user_id)
+        # The sender already drew it locally; solo rooms have no one to tell
+        if not manager.has_peers(room_id):
+            return
+        payload = b'{"type":"stroke","stroke":' + manager.encoded_stroke(room_id, stroke) + b"}"
+        await manager.broadcast_bytes(room_id, payload, exclude=user_id)
     
     elif msg_type == "undo":
         removed = manager.remove_last_stroke(room_id, user_id)
@@ -534,7 +1338,7 @@ async def handle_message(room_id: str, user_id: str, nickname: str, data: dict):
         manager.add_layer(room_id, layer)
         await manager.broadcast(room_id, {
             "type": "layer_added",
-            "layer": asdict(layer)
+            "layer": layer.to_dict()
         })
     
     elif msg_type == "clear_layer":
@@ -546,13 +1350,15 @@ async def handle_message(room_id: str, user_id: str, nickname: str, data: dict):
         })
     
     elif msg_type == "cursor":
-        await manager.broadcast(room_id, {
-            "type": "cursor",
-            "user_id": user_id,
-            "x": data["x"],
-            "y": data["y"],
-            "color": manager.user_info.get(user_id, {}).get("color", "#888")
-        }, exclude=user_id)
+        if not manager.has_peers(room_id):
+            return
+        # Cursors are the highest-rate frames, so they go out as short-keyed
+        # MessagePack; clients already know each user's color from the user list
+        _cursor_envelope["u"] = user_id
+        # Whole pixels pack as 1-3 byte ints rather than 9-byte floats
+        _cursor_envelope["x"] = round(data["x"])
+        _cursor_envelope["y"] = round(data["y"])
+        manager.send_cursor(room_id, user_id, _cursor_packer.pack(_cursor_envelope))
     
     elif msg_type == "chat":
         message = ChatMessage(
@@ -560,12 +1366,12 @@ async def handle_message(room_id: str, user_id: str, nickname: str, data: dict):
             user_id=user_id,
             nickname=nickname,
             text=data["text"][:500],  # Limit message length
-            timestamp=datetime.now().timestamp()
+            timestamp=time.time()
         )
         manager.add_chat_message(room_id, message)
         await manager.broadcast(room_id, {
             "type": "chat",
-            "message": asdict(message)
+            "message": message.to_dict()
         })
     
     elif msg_type == "start_timer":
@@ -584,20 +1390,32 @@ async def handle_message(room_id: str, user_id: str, nickname: str, data: dict):
         })
     
     elif msg_type == "save_thumbnail":
-        if room_id in manager.room_data:
-            manager.room_data[room_id].thumbnail = data.get("thumbnail", "")[:50000]  # Limit size
+        manager.set_thumbnail(room_id, data.get("thumbnail", "")[:50000])  # Limit size
     
     elif msg_type == "reaction":
+        if not manager.has_peers(room_id):
+            return
         await manager.broadcast(room_id, {
             "type": "reaction",
             "user_id": user_id,
             "emoji": data.get("emoji", "👍"),
             "x": data.get("x", 0),
             "y": data.get("y", 0)
-        })
+        }, exclude=user_id)
 
 # ============= Run =============
 
 if __name__ == "__main__":
+    import sys
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+    uvicorn.run(
+        app,
+        host="0.0.0.0",
+        port=8000,
+        loop="asyncio" if sys.platform == "win32" else "uvloop",  # uvloop has no Windows build
+        http="httptools",
+        ws="websockets",
+        # Stroke/cursor frames are a few hundred bytes; deflating them costs
+        # more CPU than it saves in bandwidth
+        ws_per_message_deflate=False
+    )
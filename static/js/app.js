@@ -10,9 +10,15 @@ let nickname = null;
 let currentRoom = null;
 let myColor = '#888888';
 let userCursors = {};
+let remoteUserColors = {};
 let currentTheme = 'dark';
 let timerInterval = null;
 let soundEnabled = true;
+// "epoch:rev" of the room state last received, so a reconnect only fetches changes
+let roomSync = null;
+
+const textDecoder = new TextDecoder();
+const WIRE_PROTOCOL = 'msgpack.dt';
 
 // Audio context for sounds
 let audioCtx = null;
@@ -55,9 +61,12 @@ function initApp(roomId) {
 function connectWebSocket() {
     const protocol = window.location.protocol === 'https:' ? 'wss:' : 'ws:';
     const password = localStorage.getItem('room_password_' + currentRoom) || '';
-    const wsUrl = `${protocol}//${window.location.host}/ws/${currentRoom}?user_id=${userId}&nickname=${encodeURIComponent(nickname)}&password=${encodeURIComponent(password)}`;
+    const wsUrl = `${protocol}//${window.location.host}/ws/${currentRoom}?user_id=${userId}&nickname=${encodeURIComponent(nickname)}&password=${encodeURIComponent(password)}${roomSync ? '&since=' + encodeURIComponent(roomSync) : ''}`;
     
-    ws = new WebSocket(wsUrl);
+    // The server decodes MessagePack frames without a JSON parse; it falls
+    // back to JSON text if it doesn't agree to the subprotocol
+    ws = new WebSocket(wsUrl, WIRE_PROTOCOL);
+    ws.binaryType = 'arraybuffer';
     
     ws.onopen = () => {
         updateConnectionStatus('connected');
@@ -75,13 +84,30 @@ function connectWebSocket() {
     };
     
     ws.onmessage = (event) => {
-        const data = JSON.parse(event.data);
-        handleServerMessage(data);
+        if (typeof event.data === 'string') {
+            handleServerMessage(JSON.parse(event.data));
+            return;
+        }
+        // Binary frames are either UTF-8 JSON objects or compact MessagePack
+        // messages (cursor updates); a JSON object always starts with '{'
+        const bytes = new Uint8Array(event.data);
+        if (bytes[0] === 0x7b) {
+            handleServerMessage(JSON.parse(textDecoder.decode(bytes)));
+        } else {
+            handleCompactMessage(MsgPack.decode(bytes));
+        }
     };
 }
 
+function encodeMessage(message) {
+    return ws.protocol === WIRE_PROTOCOL ? MsgPack.encode(message) : JSON.stringify(message);
+}
+
 function handleServerMessage(data) {
     switch (data.type) {
+        case 'batch':
+            data.events.forEach(handleServerMessage);
+            break;
         case 'init':
             handleInit(data);
             break;
@@ -136,6 +162,14 @@ function handleServerMessage(data) {
     }
 }
 
+function handleCompactMessage(data) {
+    switch (data.t) {
+        case 'c':
+            updateRemoteCursor(data.u, data.x, data.y, remoteUserColors[data.u]);
+            break;
+    }
+}
+
 function handleInit(data) {
     const room = data.room;
     myColor = data.your_color;
@@ -144,8 +178,14 @@ function handleInit(data) {
     drawingCanvas.setLayers(room.layers);
     renderLayersPanel();
     
-    // Load existing strokes
-    drawingCanvas.loadStrokes(room.strokes);
+    // Load existing strokes, or just what changed since our last connection
+    const strokes = room.strokes.map(inflateStroke);
+    if (room.since !== undefined) {
+        drawingCanvas.mergeStrokes(strokes, room.removed_stroke_ids);
+    } else {
+        drawingCanvas.loadStrokes(strokes);
+    }
+    roomSync = `${room.epoch}:${room.rev}`;
     
     // Update users
     updateUsersList(data.users);
@@ -168,10 +208,10 @@ function handleInit(data) {
 
 function handleStrokeComplete(stroke) {
     if (ws && ws.readyState === WebSocket.OPEN) {
-        ws.send(JSON.stringify({
+        ws.send(encodeMessage({
             type: 'stroke',
             id: stroke.id,
-            points: stroke.points,
+            points: wirePoints(stroke.points),
             color: stroke.color,
             size: stroke.size,
             layer_id: stroke.layer_id,
@@ -184,12 +224,25 @@ function handleStrokeComplete(stroke) {
 }
 
 function handleRemoteStroke(stroke) {
-    drawingCanvas.addRemoteStroke(stroke);
+    drawingCanvas.addRemoteStroke(inflateStroke(stroke));
+}
+
+// Strokes travel with packed points (base64 in JSON); the canvas draws {x, y} lists
+function inflateStroke(stroke) {
+    if (typeof stroke.points === 'string') {
+        stroke.points = PackedPoints.unpack(stroke.points);
+    }
+    return stroke;
+}
+
+function wirePoints(points) {
+    const packed = PackedPoints.pack(points);
+    return ws.protocol === WIRE_PROTOCOL ? packed : PackedPoints.toBase64(packed);
 }
 
 function handleCursorMove(x, y) {
     if (ws && ws.readyState === WebSocket.OPEN) {
-        ws.send(JSON.stringify({
+        ws.send(encodeMessage({
             type: 'cursor',
             x: Math.round(x),
             y: Math.round(y)
@@ -247,6 +300,7 @@ function removeCursor(remoteUserId) {
 
 function updateUsersList(users) {
     const list = document.getElementById('users-list');
+    users.forEach(user => { remoteUserColors[user.id] = user.color; });
     list.innerHTML = users.map(user => {
         const isMe = user.id === userId;
         return `
@@ -280,7 +334,7 @@ function sendChatMessage() {
     const text = input.value.trim();
     
     if (text && ws && ws.readyState === WebSocket.OPEN) {
-        ws.send(JSON.stringify({
+        ws.send(encodeMessage({
             type: 'chat',
             text: text
         }));
@@ -365,12 +419,14 @@ function formatTime(seconds) {
 function sendReaction(emoji) {
     if (ws && ws.readyState === WebSocket.OPEN) {
         const canvas = document.getElementById('main-canvas');
-        ws.send(JSON.stringify({
+        ws.send(encodeMessage({
             type: 'reaction',
             emoji: emoji,
             x: canvas.width / 2,
             y: canvas.height / 2
         }));
+        // The server only relays reactions to other users
+        showReaction(emoji, canvas.width / 2, canvas.height / 2);
     }
 }
 
@@ -505,12 +561,12 @@ function setupKeyboardShortcuts() {
                         // Redo
                         const redone = drawingCanvas.redo();
                         if (redone && ws) {
-                            ws.send(JSON.stringify({ type: 'stroke', ...redone }));
+                            ws.send(encodeMessage({ type: 'stroke', ...redone, points: wirePoints(redone.points) }));
                         }
                     } else {
                         // Undo
                         if (ws && ws.readyState === WebSocket.OPEN) {
-                            ws.send(JSON.stringify({ type: 'undo' }));
+                            ws.send(encodeMessage({ type: 'undo' }));
                         }
                         drawingCanvas.undo();
                     }
@@ -519,7 +575,7 @@ function setupKeyboardShortcuts() {
                     e.preventDefault();
                     const redone = drawingCanvas.redo();
                     if (redone && ws) {
-                        ws.send(JSON.stringify({ type: 'stroke', ...redone }));
+                        ws.send(encodeMessage({ type: 'stroke', ...redone, points: wirePoints(redone.points) }));
                     }
                     break;
                 case 's':
@@ -638,7 +694,7 @@ function setupUI() {
     if (undoBtn) {
         undoBtn.addEventListener('click', () => {
             if (ws && ws.readyState === WebSocket.OPEN) {
-                ws.send(JSON.stringify({ type: 'undo' }));
+                ws.send(encodeMessage({ type: 'undo' }));
             }
             drawingCanvas.undo();
         });
@@ -650,7 +706,7 @@ function setupUI() {
         clearBtn.addEventListener('click', () => {
             if (confirm('Clear current layer?')) {
                 if (ws && ws.readyState === WebSocket.OPEN) {
-                    ws.send(JSON.stringify({ 
+                    ws.send(encodeMessage({ 
                         type: 'clear_layer', 
                         layer_id: drawingCanvas.currentLayerId 
                     }));
@@ -668,7 +724,7 @@ function setupUI() {
             if (name) {
                 const layerId = 'layer_' + Date.now();
                 if (ws && ws.readyState === WebSocket.OPEN) {
-                    ws.send(JSON.stringify({ 
+                    ws.send(encodeMessage({ 
                         type: 'add_layer',
                         id: layerId,
                         name: name
@@ -720,7 +776,7 @@ function setupUI() {
             const minutes = prompt('Timer duration (minutes):', '5');
             if (minutes && !isNaN(minutes)) {
                 if (ws && ws.readyState === WebSocket.OPEN) {
-                    ws.send(JSON.stringify({
+                    ws.send(encodeMessage({
                         type: 'start_timer',
                         duration: parseInt(minutes) * 60
                     }));
@@ -816,7 +872,7 @@ function exportCanvas() {
 function saveThumbnail() {
     if (ws && ws.readyState === WebSocket.OPEN) {
         const thumbnail = drawingCanvas.getThumbnail(200);
-        ws.send(JSON.stringify({
+        ws.send(encodeMessage({
             type: 'save_thumbnail',
             thumbnail: thumbnail
         }));
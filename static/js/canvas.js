@@ -572,6 +572,14 @@ class DrawingCanvas {
         this.redraw();
     }
     
+    mergeStrokes(strokes, removedIds) {
+        // Re-added strokes (redo) move to the end, like on the server
+        const replaced = new Set(removedIds);
+        strokes.forEach(s => replaced.add(s.id));
+        this.strokes = this.strokes.filter(s => !replaced.has(s.id)).concat(strokes);
+        this.redraw();
+    }
+    
     // ============= Undo/Redo =============
     
     undo() {
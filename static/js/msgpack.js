@@ -0,0 +1,148 @@
+/**
+ * Minimal MessagePack codec
+ * Covers nil, bool, ints, floats, str, bin, array and map, which is all the
+ * server sends and all the client needs to send
+ */
+
+const MsgPack = (() => {
+    const textDecoder = new TextDecoder();
+    const textEncoder = new TextEncoder();
+
+    function encode(value) {
+        let bytes = new Uint8Array(256);
+        let view = new DataView(bytes.buffer);
+        let pos = 0;
+
+        function reserve(length) {
+            if (pos + length <= bytes.length) return;
+            let size = bytes.length * 2;
+            while (size < pos + length) size *= 2;
+            const grown = new Uint8Array(size);
+            grown.set(bytes);
+            bytes = grown;
+            view = new DataView(bytes.buffer);
+        }
+
+        function head(small, type8, type16, type32, length) {
+            if (small !== null && length < 16) { reserve(1); bytes[pos++] = small | length; }
+            else if (type8 !== null && length < 0x100) { reserve(2); bytes[pos++] = type8; bytes[pos++] = length; }
+            else if (length < 0x10000) { reserve(3); bytes[pos++] = type16; view.setUint16(pos, length); pos += 2; }
+            else { reserve(5); bytes[pos++] = type32; view.setUint32(pos, length); pos += 4; }
+        }
+
+        function number(n) {
+            if (Number.isInteger(n) && n >= -0x80000000 && n <= 0xffffffff) {
+                if (n >= 0 && n <= 0x7f) { reserve(1); bytes[pos++] = n; }
+                else if (n < 0 && n >= -32) { reserve(1); bytes[pos++] = n + 0x100; }
+                else if (n >= 0) { reserve(5); bytes[pos++] = 0xce; view.setUint32(pos, n); pos += 4; }
+                else { reserve(5); bytes[pos++] = 0xd2; view.setInt32(pos, n); pos += 4; }
+            } else {
+                reserve(9); bytes[pos++] = 0xcb; view.setFloat64(pos, n); pos += 8;
+            }
+        }
+
+        function write(v) {
+            if (v === null || v === undefined) { reserve(1); bytes[pos++] = 0xc0; }
+            else if (v === false) { reserve(1); bytes[pos++] = 0xc2; }
+            else if (v === true) { reserve(1); bytes[pos++] = 0xc3; }
+            else if (typeof v === 'number') number(v);
+            else if (typeof v === 'string') {
+                const encoded = textEncoder.encode(v);
+                if (encoded.length < 32) { reserve(1); bytes[pos++] = 0xa0 | encoded.length; }
+                else head(null, 0xd9, 0xda, 0xdb, encoded.length);
+                reserve(encoded.length); bytes.set(encoded, pos); pos += encoded.length;
+            }
+            else if (v instanceof Uint8Array) {
+                head(null, 0xc4, 0xc5, 0xc6, v.length);
+                reserve(v.length); bytes.set(v, pos); pos += v.length;
+            }
+            else if (Array.isArray(v)) {
+                head(0x90, null, 0xdc, 0xdd, v.length);
+                for (const item of v) write(item);
+            }
+            else {
+                const keys = Object.keys(v).filter(k => v[k] !== undefined);
+                head(0x80, null, 0xde, 0xdf, keys.length);
+                for (const key of keys) { write(key); write(v[key]); }
+            }
+        }
+
+        write(value);
+        return bytes.slice(0, pos);
+    }
+
+    function decode(buffer) {
+        const bytes = buffer instanceof Uint8Array ? buffer : new Uint8Array(buffer);
+        const view = new DataView(bytes.buffer, bytes.byteOffset, bytes.byteLength);
+        let pos = 0;
+
+        function str(length) {
+            const value = textDecoder.decode(bytes.subarray(pos, pos + length));
+            pos += length;
+            return value;
+        }
+
+        function bin(length) {
+            const value = bytes.slice(pos, pos + length);
+            pos += length;
+            return value;
+        }
+
+        function array(length) {
+            const value = new Array(length);
+            for (let i = 0; i < length; i++) value[i] = read();
+            return value;
+        }
+
+        function map(length) {
+            const value = {};
+            for (let i = 0; i < length; i++) {
+                const key = read();
+                value[key] = read();
+            }
+            return value;
+        }
+
+        function read() {
+            const type = bytes[pos++];
+            let value;
+
+            if (type <= 0x7f) return type;                           // positive fixint
+            if (type >= 0xe0) return type - 0x100;                   // negative fixint
+            if ((type & 0xf0) === 0x80) return map(type & 0x0f);     // fixmap
+            if ((type & 0xf0) === 0x90) return array(type & 0x0f);   // fixarray
+            if ((type & 0xe0) === 0xa0) return str(type & 0x1f);     // fixstr
+
+            switch (type) {
+                case 0xc0: return null;
+                case 0xc2: return false;
+                case 0xc3: return true;
+                case 0xc4: value = bytes[pos]; pos += 1; return bin(value);
+                case 0xc5: value = view.getUint16(pos); pos += 2; return bin(value);
+                case 0xc6: value = view.getUint32(pos); pos += 4; return bin(value);
+                case 0xca: value = view.getFloat32(pos); pos += 4; return value;
+                case 0xcb: value = view.getFloat64(pos); pos += 8; return value;
+                case 0xcc: value = view.getUint8(pos); pos += 1; return value;
+                case 0xcd: value = view.getUint16(pos); pos += 2; return value;
+                case 0xce: value = view.getUint32(pos); pos += 4; return value;
+                case 0xcf: value = Number(view.getBigUint64(pos)); pos += 8; return value;
+                case 0xd0: value = view.getInt8(pos); pos += 1; return value;
+                case 0xd1: value = view.getInt16(pos); pos += 2; return value;
+                case 0xd2: value = view.getInt32(pos); pos += 4; return value;
+                case 0xd3: value = Number(view.getBigInt64(pos)); pos += 8; return value;
+                case 0xd9: value = bytes[pos]; pos += 1; return str(value);
+                case 0xda: value = view.getUint16(pos); pos += 2; return str(value);
+                case 0xdb: value = view.getUint32(pos); pos += 4; return str(value);
+                case 0xdc: value = view.getUint16(pos); pos += 2; return array(value);
+                case 0xdd: value = view.getUint32(pos); pos += 4; return array(value);
+                case 0xde: value = view.getUint16(pos); pos += 2; return map(value);
+                case 0xdf: value = view.getUint32(pos); pos += 4; return map(value);
+            }
+            throw new Error(`Unsupported MessagePack type 0x${type.toString(16)}`);
+        }
+
+        return read();
+    }
+
+    return { encode, decode };
+})();
@@ -0,0 +1,53 @@
+/**
+ * Packed stroke points
+ * Little-endian int16 x0, y0 followed by a (dx, dy) pair per point:
+ * 4 bytes a point instead of ~20 for {"x":..,"y":..} in JSON
+ */
+
+const PackedPoints = (() => {
+    function clamp(value) {
+        return Math.max(-32768, Math.min(32767, value));
+    }
+
+    function pack(points) {
+        const view = new DataView(new ArrayBuffer(points.length * 4));
+        let x = 0, y = 0;
+        points.forEach((point, i) => {
+            // Deltas are taken from the rounded previous point so no error accumulates
+            const px = Math.round(point.x), py = Math.round(point.y);
+            view.setInt16(i * 4, clamp(px - x), true);
+            view.setInt16(i * 4 + 2, clamp(py - y), true);
+            x += view.getInt16(i * 4, true);
+            y += view.getInt16(i * 4 + 2, true);
+        });
+        return new Uint8Array(view.buffer);
+    }
+
+    function unpack(packed) {
+        const bytes = typeof packed === 'string' ? fromBase64(packed) : packed;
+        const view = new DataView(bytes.buffer, bytes.byteOffset, bytes.byteLength);
+        const points = new Array(bytes.byteLength / 4);
+        let x = 0, y = 0;
+        for (let i = 0; i < points.length; i++) {
+            x += view.getInt16(i * 4, true);
+            y += view.getInt16(i * 4 + 2, true);
+            points[i] = { x, y };
+        }
+        return points;
+    }
+
+    function toBase64(bytes) {
+        let binary = '';
+        for (let i = 0; i < bytes.length; i++) binary += String.fromCharCode(bytes[i]);
+        return btoa(binary);
+    }
+
+    function fromBase64(text) {
+        const binary = atob(text);
+        const bytes = new Uint8Array(binary.length);
+        for (let i = 0; i < binary.length; i++) bytes[i] = binary.charCodeAt(i);
+        return bytes;
+    }
+
+    return { pack, unpack, toBase64 };
+})();
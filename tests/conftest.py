@@ -4,12 +4,23 @@ Pytest Configuration and Fixtures
 
 import pytest
 import asyncio
+import functools
+import json
 import os
+import queue
 import sys
+import threading
+import time
+from httpx import AsyncClient, ASGITransport
 
-# Add parent directory to path
+# Make the top-level app module importable; this is the only place the
+# test suite touches sys.path
 sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
+# 1x1 PNG as the canvas exports it, for gallery posts
+TINY_PNG_B64 = "data:image/png;base64,iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAYAAAAfFcSJAAAADUlEQVR42mNk+M9QDwADhgGAWjR9awAAAABJRU5ErkJggg=="
+
+
 @pytest.fixture(autouse=True)
 def setup_test_db(tmp_path, monkeypatch):
     """Use temporary database for tests"""
@@ -21,3 +32,151 @@ def setup_test_db(tmp_path, monkeypatch):
     loop = asyncio.new_event_loop()
     loop.run_until_complete(app.init_db())
     loop.close()
+    
+    yield
+    
+    loop = asyncio.new_event_loop()
+    loop.run_until_complete(app.close_db())
+    loop.close()
+
+
+@pytest.fixture(autouse=True)
+def release_empty_rooms():
+    """Evict rooms nobody is connected to after each test, so the shared
+    manager doesn't keep every room the run has touched. Rooms held open by
+    a class-scoped room_ws session survive until their class is done."""
+    from app import manager
+    yield
+    for room_id in [rid for rid in manager.room_data if not manager.rooms.get(rid)]:
+        # Unflushed changes are never written; each test gets a new database
+        manager.dirty_rooms.discard(room_id)
+        manager.pending_strokes.pop(room_id, None)
+        manager.removed_strokes.pop(room_id, None)
+        manager.evict_room(room_id)
+
+
+@pytest.fixture(scope="module")
+def event_loop():
+    """One loop per test module instead of a new one per async test"""
+    loop = asyncio.new_event_loop()
+    yield loop
+    loop.close()
+
+
+@pytest.fixture(scope="module")
+async def async_client():
+    """Async test client, shared by the module's HTTP tests"""
+    from app import app
+    transport = ASGITransport(app=app)
+    async with AsyncClient(transport=transport, base_url="http://test") as ac:
+        yield ac
+
+
+@pytest.fixture(scope="session")
+def line_points():
+    """line_points(n) -> n points along y = 2x, built once per length per session.
+    The point dicts are shared, so copy them before mutating."""
+    @functools.lru_cache(maxsize=None)
+    def build(n):
+        return tuple({"x": i, "y": i * 2} for i in range(n))
+    return build
+
+
+def wait_until(predicate, timeout=1.0, step=0.005):
+    """Poll `predicate` until it is truthy; for effects the server doesn't echo"""
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        if time.monotonic() > deadline:
+            raise AssertionError("condition not met within %.1fs" % timeout)
+        time.sleep(step)
+
+
+def receive_within(ws, timeout):
+    """`ws.receive_bytes()`, failing the test if nothing arrives in `timeout`.
+    
+    TestClient sessions have no receive timeout, so the read runs in a daemon
+    thread. One that times out stays blocked and takes the session's next
+    frame, which only matters to a test that has already failed."""
+    result = queue.SimpleQueue()
+    
+    def read():
+        try:
+            result.put((True, ws.receive_bytes()))
+        except BaseException as exc:
+            result.put((False, exc))
+    
+    threading.Thread(target=read, daemon=True).start()
+    try:
+        ok, value = result.get(timeout=timeout)
+    except queue.Empty:
+        raise AssertionError("no frame within %.1fs" % timeout) from None
+    if not ok:
+        raise value
+    return value
+
+
+def iter_events(ws, timeout=1.0, max_frames=100):
+    """JSON events from `ws` as they arrive, with batch frames unpacked.
+    
+    Fails the test once `timeout` passes or `max_frames` frames have been
+    read without the caller finding what it wanted."""
+    deadline = time.monotonic() + timeout
+    for _ in range(max_frames):
+        frame = receive_within(ws, max(deadline - time.monotonic(), 0))
+        data = json.loads(frame)
+        if data["type"] == "batch":
+            yield from data["events"]
+        else:
+            yield data
+    raise AssertionError("expected event not among %d frames" % max_frames)
+
+
+def receive_type(ws, msg_type, **limits):
+    """Next event of `msg_type`, skipping any earlier ones still queued"""
+    for data in iter_events(ws, **limits):
+        if data["type"] == msg_type:
+            return data
+
+
+class FakeWS:
+    """Records sent frames in `sent`; far cheaper than an AsyncMock per socket"""
+    
+    def __init__(self):
+        self.sent = []
+    
+    async def accept(self, subprotocol=None):
+        pass
+    
+    async def send_bytes(self, data):
+        self.sent.append(data)
+
+
+class PersistentWS:
+    """WebSocket sessions opened on first use, one per room, and kept open
+    until close(). The init frame is drained on connect and kept in `init`."""
+    
+    def __init__(self, client):
+        self.client = client
+        self.init = {}
+        self._sessions = {}
+    
+    def __getitem__(self, room_id):
+        if room_id not in self._sessions:
+            session = self.client.websocket_connect(f"/ws/{room_id}?user_id={room_id}-user&nickname=Tester")
+            ws = session.__enter__()
+            self.init[room_id] = ws.receive_json(mode="binary")
+            self._sessions[room_id] = (session, ws)
+        return self._sessions[room_id][1]
+    
+    def close(self):
+        for session, _ in self._sessions.values():
+            session.__exit__(None, None, None)
+        self._sessions.clear()
+
+
+@pytest.fixture(scope="class")
+def room_ws(client):
+    """One WebSocket per room, shared by every test in the class"""
+    sessions = PersistentWS(client)
+    yield sessions
+    sessions.close()
@@ -4,16 +4,15 @@ Chat, Gallery, Timer, Password Protection
 """
 
 import pytest
+import base64
 import time
 from fastapi.testclient import TestClient
 
-import sys
-sys.path.insert(0, '..')
+from app import app, manager
+from tests.conftest import TINY_PNG_B64, receive_type, wait_until
 
-from app import app, manager, ChatMessage, save_to_gallery, get_gallery, like_gallery_item
 
-
-@pytest.fixture
+@pytest.fixture(scope="module")
 def client():
     return TestClient(app)
 
@@ -21,80 +20,69 @@ def client():
 class TestChatFeature:
     """Test real-time chat functionality"""
     
-    def test_chat_message_sent_and_received(self, client):
+    def test_chat_message_sent_and_received(self, room_ws):
         """Test sending and receiving chat messages"""
-        with client.websocket_connect("/ws/chat-room?user_id=chatter&nickname=Chatter") as ws:
-            ws.receive_json()  # init
-            
-            # Send chat message
-            ws.send_json({
-                "type": "chat",
-                "text": "Hello everyone!"
-            })
-            
-            time.sleep(0.1)
-            
-            # Verify message was stored
-            room = manager.room_data.get("chat-room")
-            assert len(room.chat_messages) > 0
-            assert room.chat_messages[-1].text == "Hello everyone!"
+        ws = room_ws["chat-room"]
+        
+        # Send chat message
+        ws.send_json({
+            "type": "chat",
+            "text": "Hello everyone!"
+        })
+        
+        assert receive_type(ws, "chat")["message"]["text"] == "Hello everyone!"
+        
+        # Verify message was stored
+        room = manager.room_data.get("chat-room")
+        assert len(room.chat_messages) > 0
+        assert room.chat_messages[-1].text == "Hello everyone!"
     
-    def test_chat_message_length_limit(self, client):
+    @pytest.mark.parametrize("length,expected", [(1000, 500), (500, 500), (10, 10)])
+    def test_chat_message_length_limit(self, room_ws, length, expected):
         """Test that chat messages are limited to 500 characters"""
-        with client.websocket_connect("/ws/chat-limit?user_id=limiter&nickname=Limiter") as ws:
-            ws.receive_json()
-            
-            # Send very long message
-            long_text = "A" * 1000
-            ws.send_json({
-                "type": "chat",
-                "text": long_text
-            })
-            
-            time.sleep(0.1)
-            
-            room = manager.room_data.get("chat-limit")
-            # Message should be truncated to 500 chars
-            assert len(room.chat_messages[-1].text) == 500
+        ws = room_ws["chat-room"]
+        
+        ws.send_json({
+            "type": "chat",
+            "text": "A" * length
+        })
+        assert len(receive_type(ws, "chat")["message"]["text"]) == expected
+        
+        room = manager.room_data.get("chat-room")
+        assert len(room.chat_messages[-1].text) == expected
 
 
 class TestTimerFeature:
     """Test timer functionality"""
     
-    def test_timer_start(self, client):
+    def test_timer_start(self, room_ws):
         """Test starting a timer"""
-        with client.websocket_connect("/ws/timer-room?user_id=timer-user&nickname=Timer") as ws:
-            ws.receive_json()  # init
-            
-            # Start timer for 5 minutes
-            ws.send_json({
-                "type": "start_timer",
-                "duration": 300
-            })
-            
-            time.sleep(0.1)
-            
-            room = manager.room_data.get("timer-room")
-            assert room.timer_end is not None
-            assert room.timer_end > time.time()
+        ws = room_ws["timer-room"]
+        
+        # Start timer for 5 minutes
+        ws.send_json({
+            "type": "start_timer",
+            "duration": 300
+        })
+        receive_type(ws, "timer_started")
+        
+        room = manager.room_data.get("timer-room")
+        assert room.timer_end is not None
+        assert room.timer_end > time.time()
     
-    def test_timer_max_duration(self, client):
+    @pytest.mark.parametrize("duration,cap", [(7200, 3600), (3600, 3600), (10, 10)])
+    def test_timer_max_duration(self, room_ws, duration, cap):
         """Test timer is limited to 1 hour max"""
-        with client.websocket_connect("/ws/timer-max?user_id=timer-max&nickname=MaxTimer") as ws:
-            ws.receive_json()
-            
-            # Try to set 2 hour timer
-            ws.send_json({
-                "type": "start_timer",
-                "duration": 7200  # 2 hours
-            })
-            
-            time.sleep(0.1)
-            
-            room = manager.room_data.get("timer-max")
-            # Should be capped at 1 hour (3600 seconds)
-            expected_max = time.time() + 3600
-            assert room.timer_end <= expected_max + 1
+        ws = room_ws["timer-room"]
+        
+        ws.send_json({
+            "type": "start_timer",
+            "duration": duration
+        })
+        assert receive_type(ws, "timer_started")["duration"] == cap
+        
+        room = manager.room_data.get("timer-room")
+        assert room.timer_end <= time.time() + cap + 1
 
 
 class TestPasswordProtection:
@@ -105,7 +93,7 @@ class TestPasswordProtection:
         with client.websocket_connect(
             "/ws/protected-room?user_id=creator&nickname=Creator&password=secret123"
         ) as ws:
-            data = ws.receive_json()
+            data = ws.receive_json(mode="binary")
             assert data["type"] == "init"
             assert data["room"]["has_password"] == True
     
@@ -115,13 +103,13 @@ class TestPasswordProtection:
         with client.websocket_connect(
             "/ws/protected-test?user_id=owner&nickname=Owner&password=correctpass"
         ) as ws:
-            ws.receive_json()
+            ws.receive_json(mode="binary")
         
         # Try to join with wrong password
         with client.websocket_connect(
             "/ws/protected-test?user_id=intruder&nickname=Intruder&password=wrongpass"
         ) as ws:
-            data = ws.receive_json()
+            data = ws.receive_json(mode="binary")
             assert data["type"] == "error"
             assert "password" in data["message"].lower()
 
@@ -129,44 +117,101 @@ class TestPasswordProtection:
 class TestGalleryFeature:
     """Test gallery functionality"""
     
-    def test_gallery_page_loads(self, client):
+    async def test_gallery_page_loads(self, async_client):
         """Test gallery page loads"""
-        response = client.get("/gallery")
+        response = await async_client.get("/gallery")
         assert response.status_code == 200
         assert "Gallery" in response.text
     
-    def test_get_gallery_empty(self, client):
+    async def test_get_gallery_empty(self, async_client):
         """Test getting empty gallery"""
-        response = client.get("/api/gallery")
+        response = await async_client.get("/api/gallery")
         assert response.status_code == 200
         assert isinstance(response.json(), list)
     
-    def test_post_to_gallery(self, client):
+    async def test_post_to_gallery(self, async_client):
         """Test posting artwork to gallery"""
-        response = client.post("/api/gallery", json={
+        response = await async_client.post("/api/gallery", json={
             "room_id": "test-room",
             "title": "My Masterpiece",
             "author": "Test Artist",
-            "image_data": "data:image/png;base64,iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAYAAAAfFcSJAAAADUlEQVR42mNk+M9QDwADhgGAWjR9awAAAABJRU5ErkJggg=="
+            "image_data": TINY_PNG_B64
         })
         
         assert response.status_code == 200
         assert "id" in response.json()
     
-    def test_like_gallery_item(self, client):
+    async def test_post_to_gallery_rejects_bad_image(self, async_client):
+        """Test that image data that isn't a base64 PNG data URL is refused"""
+        for image_data in ("not-a-data-url!!", "data:image/png;base64,!!notbase64",
+                           "data:image/svg+xml;base64," + TINY_PNG_B64.split(",", 1)[1]):
+            response = await async_client.post("/api/gallery", json={
+                "room_id": "bad-image",
+                "title": "Broken",
+                "author": "Artist",
+                "image_data": image_data
+            })
+            assert response.status_code == 400
+        
+        listing = (await async_client.get("/api/gallery")).json()
+        assert not any(i["room_id"] == "bad-image" for i in listing)
+    
+    async def test_gallery_image_served_separately(self, async_client):
+        """Test the listing links to the image instead of embedding it"""
+        png = base64.b64decode(TINY_PNG_B64.split(",", 1)[1])
+        post_response = await async_client.post("/api/gallery", json={
+            "room_id": "image-test",
+            "title": "Pixel",
+            "author": "Artist",
+            "image_data": TINY_PNG_B64
+        })
+        gallery_id = post_response.json()["id"]
+        
+        item = next(i for i in (await async_client.get("/api/gallery")).json() if i["id"] == gallery_id)
+        assert "image_data" not in item
+        
+        response = await async_client.get(item["image_url"])
+        assert response.status_code == 200
+        assert response.headers["content-type"] == "image/png"
+        assert response.content == png
+    
+    async def test_gallery_listing_refreshes_after_like(self, async_client):
+        """Test the cached gallery listing is rebuilt when an item changes"""
+        post_response = await async_client.post("/api/gallery", json={
+            "room_id": "cache-test",
+            "title": "Cached",
+            "author": "Artist",
+            "image_data": TINY_PNG_B64
+        })
+        gallery_id = post_response.json()["id"]
+        
+        async def likes():
+            listing = (await async_client.get("/api/gallery")).json()
+            return next(i["likes"] for i in listing if i["id"] == gallery_id)
+        
+        assert await likes() == 0
+        await async_client.post(f"/api/gallery/{gallery_id}/like")
+        assert await likes() == 1
+    
+    async def test_gallery_image_missing(self, async_client):
+        """Test unknown gallery ids return 404"""
+        response = await async_client.get("/api/gallery/nope/image")
+        assert response.status_code == 404
+    
+    async def test_like_gallery_item(self, async_client):
         """Test liking a gallery item"""
         # First create an item
-        post_response = client.post("/api/gallery", json={
+        post_response = await async_client.post("/api/gallery", json={
             "room_id": "like-test",
             "title": "Likeable Art",
             "author": "Artist",
-            "image_data": "data:image/png;base64,test"
+            "image_data": TINY_PNG_B64
         })
         
         gallery_id = post_response.json()["id"]
         
         # Like it
-        like_response = client.post(f"/api/gallery/{gallery_id}/like")
+        like_response = await async_client.post(f"/api/gallery/{gallery_id}/like")
         assert like_response.status_code == 200
         assert like_response.json()["status"] == "liked"
 
@@ -174,9 +219,9 @@ class TestGalleryFeature:
 class TestReactionsFeature:
     """Test reactions/stickers functionality"""
     
-    def test_get_stickers(self, client):
+    async def test_get_stickers(self, async_client):
         """Test getting available stickers"""
-        response = client.get("/api/stickers")
+        response = await async_client.get("/api/stickers")
         
         assert response.status_code == 200
         stickers = response.json()
@@ -188,7 +233,7 @@ class TestReactionsFeature:
     def test_reaction_broadcast(self, client):
         """Test sending a reaction"""
         with client.websocket_connect("/ws/reaction-room?user_id=reactor&nickname=Reactor") as ws:
-            ws.receive_json()  # init
+            ws.receive_json(mode="binary")  # init
             
             ws.send_json({
                 "type": "reaction",
@@ -204,9 +249,9 @@ class TestReactionsFeature:
 class TestShortcutsAPI:
     """Test keyboard shortcuts API"""
     
-    def test_get_shortcuts(self, client):
+    async def test_get_shortcuts(self, async_client):
         """Test getting keyboard shortcuts"""
-        response = client.get("/api/shortcuts")
+        response = await async_client.get("/api/shortcuts")
         
         assert response.status_code == 200
         shortcuts = response.json()
@@ -222,7 +267,7 @@ class TestRoomStats:
         """Test getting room statistics"""
         # First create a room
         with client.websocket_connect("/ws/stats-room?user_id=stat-user&nickname=Stat") as ws:
-            ws.receive_json()
+            ws.receive_json(mode="binary")
         
         # Get stats
         response = client.get("/api/rooms/stats-room/stats")
@@ -242,26 +287,25 @@ class TestRoomStats:
 class TestToolTypes:
     """Test different tool types in strokes"""
     
-    def test_stroke_with_tool_type(self, client):
+    def test_stroke_with_tool_type(self, room_ws):
         """Test sending stroke with specific tool type"""
-        with client.websocket_connect("/ws/tool-test?user_id=tooler&nickname=Tooler") as ws:
-            ws.receive_json()
-            
-            # Send line stroke
-            ws.send_json({
-                "type": "stroke",
-                "id": "line_stroke_1",
-                "points": [{"x": 0, "y": 0}, {"x": 100, "y": 100}],
-                "color": "#000000",
-                "size": 2,
-                "layer_id": "layer_0",
-                "tool": "line"
-            })
-            
-            time.sleep(0.1)
-            
-            room = manager.room_data.get("tool-test")
-            stroke = next((s for s in room.strokes if s.id == "line_stroke_1"), None)
-            assert stroke is not None
-            assert stroke.tool == "line"
+        ws = room_ws["tool-test"]
+        
+        # Send line stroke
+        ws.send_json({
+            "type": "stroke",
+            "id": "line_stroke_1",
+            "points": [{"x": 0, "y": 0}, {"x": 100, "y": 100}],
+            "color": "#000000",
+            "size": 2,
+            "layer_id": "layer_0",
+            "tool": "line"
+        })
+        
+        # Strokes aren't echoed to the sender
+        room = manager.room_data.get("tool-test")
+        wait_until(lambda: "line_stroke_1" in room.strokes)
+        stroke = room.strokes.get("line_stroke_1")
+        assert stroke is not None
+        assert stroke.tool == "line"
 
@@ -6,13 +6,16 @@ Tests HTTP endpoints and WebSocket connections
 import pytest
 import asyncio
 from fastapi.testclient import TestClient
-from httpx import AsyncClient, ASGITransport
+import base64
+import contextlib
+import hashlib
 import json
+import struct
+import msgpack
 
-import sys
-sys.path.insert(0, '..')
-
-from app import app, init_db, manager
+from app import app, manager, flush_dirty_rooms, evict_idle_rooms, load_room, Room, Layer, Stroke
+import app as app_module
+from tests.conftest import iter_events, receive_type
 
 
 @pytest.fixture(scope="module")
@@ -21,40 +24,48 @@ def client():
     return TestClient(app)
 
 
-@pytest.fixture
-async def async_client():
-    """Async test client for async tests"""
-    transport = ASGITransport(app=app)
-    async with AsyncClient(transport=transport, base_url="http://test") as ac:
-        yield ac
-
-
 class TestHTTPEndpoints:
     """Test HTTP API endpoints"""
     
-    def test_index_page(self, client):
+    async def test_index_page(self, async_client):
         """Test landing page loads"""
-        response = client.get("/")
+        response = await async_client.get("/")
         
         assert response.status_code == 200
         assert "DrawTogether" in response.text
         assert "Collaborative" in response.text
     
-    def test_room_page(self, client):
+    async def test_room_page(self, async_client):
         """Test room page loads with room ID"""
-        response = client.get("/room/test-room-123")
+        response = await async_client.get("/room/test-room-123")
         
         assert response.status_code == 200
         assert "test-room-123" in response.text
         assert "canvas" in response.text.lower()
     
-    def test_get_rooms_empty(self, client):
+    async def test_get_rooms_empty(self, async_client):
         """Test getting rooms list when empty"""
-        response = client.get("/api/rooms")
+        response = await async_client.get("/api/rooms")
         
         assert response.status_code == 200
         assert isinstance(response.json(), list)
     
+    def test_get_rooms_not_modified(self, client):
+        """Test that a matching If-None-Match gets a 304 until a room is saved"""
+        first = client.get("/api/rooms")
+        etag = first.headers["etag"]
+        
+        cached = client.get("/api/rooms", headers={"If-None-Match": etag})
+        assert cached.status_code == 304
+        
+        manager.room_data["etag-test"] = Room(id="etag-test", name="etag-test")
+        client.post("/api/rooms/etag-test/save")
+        
+        changed = client.get("/api/rooms", headers={"If-None-Match": etag})
+        assert changed.status_code == 200
+        assert changed.headers["etag"] != etag
+        assert "etag-test" in [r["id"] for r in changed.json()]
+    
     def test_save_room_not_found(self, client):
         """Test saving non-existent room returns 404"""
         response = client.post("/api/rooms/nonexistent-room-xyz/save")
@@ -66,121 +77,217 @@ class TestHTTPEndpoints:
 class TestWebSocketConnection:
     """Test WebSocket functionality"""
     
-    def test_websocket_connect(self, client):
+    def test_websocket_connect(self, room_ws):
         """Test WebSocket connection is established"""
-        with client.websocket_connect("/ws/test-room?user_id=test-user&nickname=Tester") as ws:
-            # Should receive init message
-            data = ws.receive_json()
-            
-            assert data["type"] == "init"
-            assert "room" in data
-            assert "users" in data
+        room_ws["ws-session"]
+        # Should receive init message
+        data = room_ws.init["ws-session"]
+        
+        assert data["type"] == "init"
+        assert "room" in data
+        assert "users" in data
     
-    def test_websocket_receives_stroke(self, client):
+    def test_websocket_receives_stroke(self, room_ws):
         """Test sending and receiving stroke data"""
-        with client.websocket_connect("/ws/stroke-test?user_id=user1&nickname=Artist") as ws:
-            # Receive init
-            init_data = ws.receive_json()
-            assert init_data["type"] == "init"
-            
-            # Send stroke
-            stroke_msg = {
-                "type": "stroke",
-                "id": "test_stroke_1",
-                "points": [{"x": 10, "y": 20}, {"x": 30, "y": 40}],
-                "color": "#FF0000",
-                "size": 5,
-                "layer_id": "layer_0"
-            }
-            ws.send_json(stroke_msg)
-            
-            # Stroke should be stored in manager
-            assert "stroke-test" in manager.room_data
+        ws = room_ws["ws-session"]
+        
+        # Send stroke
+        stroke_msg = {
+            "type": "stroke",
+            "id": "test_stroke_1",
+            "points": [{"x": 10, "y": 20}, {"x": 30, "y": 40}],
+            "color": "#FF0000",
+            "size": 5,
+            "layer_id": "layer_0"
+        }
+        ws.send_json(stroke_msg)
+        
+        # Stroke should be stored in manager
+        assert "ws-session" in manager.room_data
+    
+    def test_solo_stroke_skips_encoding(self, room_ws):
+        """Test a stroke in a room with no peers is stored but never encoded"""
+        ws = room_ws["solo-room"]
+        ws.send_json({
+            "type": "stroke", "id": "solo_1", "points": [{"x": 1, "y": 2}],
+            "color": "#000", "size": 1
+        })
+        ws.send_json({"type": "chat", "text": "sync"})
+        receive_type(ws, "chat")
+        
+        assert "solo_1" in manager.room_data["solo-room"].strokes
+        assert "solo_1" not in manager.stroke_json.get("solo-room", {})
     
     def test_websocket_multiple_users(self, client):
-        """Test multiple users in same room"""
-        with client.websocket_connect("/ws/multi-user-room?user_id=user1&nickname=Alice") as ws1:
-            init1 = ws1.receive_json()
-            assert init1["type"] == "init"
+        """Test every user in a room hears about each later join"""
+        users = 5
+        with contextlib.ExitStack() as stack:
+            sockets = []
+            for i in range(users):
+                ws = stack.enter_context(client.websocket_connect(
+                    f"/ws/multi-user-room?user_id=user{i}&nickname=N{i}"
+                ))
+                init = ws.receive_json(mode="binary")
+                assert init["type"] == "init"
+                assert len(init["users"]) == i + 1
+                sockets.append(ws)
             
-            with client.websocket_connect("/ws/multi-user-room?user_id=user2&nickname=Bob") as ws2:
-                init2 = ws2.receive_json()
-                assert init2["type"] == "init"
-                
-                # User 1 should receive notification about user 2
-                join_msg = ws1.receive_json()
-                assert join_msg["type"] == "user_joined"
-                assert join_msg["nickname"] == "Bob"
+            for i, ws in enumerate(sockets[:-1]):
+                # Queued joins may arrive merged into one batch frame
+                expected = [f"N{j}" for j in range(i + 1, users)]
+                joined = []
+                for event in iter_events(ws):
+                    joined.append(event)
+                    if len(joined) == len(expected):
+                        break
+                assert [m["type"] for m in joined] == ["user_joined"] * len(expected)
+                assert [m["nickname"] for m in joined] == expected
     
-    def test_websocket_undo(self, client):
-        """Test undo functionality removes stroke"""
-        with client.websocket_connect("/ws/undo-test?user_id=undo-user&nickname=Undoer") as ws:
-            ws.receive_json()  # init
+    def test_websocket_cursor_is_msgpack(self, client):
+        """Test cursor updates reach peers as compact MessagePack frames"""
+        with client.websocket_connect("/ws/cursor-room?user_id=mover&nickname=Mover") as ws1:
+            ws1.receive_json(mode="binary")  # init
             
-            # Send stroke
-            ws.send_json({
-                "type": "stroke",
-                "id": "undo_stroke",
-                "points": [{"x": 0, "y": 0}],
-                "color": "#000",
-                "size": 1,
-                "layer_id": "layer_0"
-            })
+            with client.websocket_connect("/ws/cursor-room?user_id=watcher&nickname=Watcher") as ws2:
+                ws2.receive_json(mode="binary")  # init
+                ws1.receive_json(mode="binary")  # user_joined
+                
+                ws1.send_json({"type": "cursor", "x": 120, "y": 45})
+                
+                frame = msgpack.unpackb(ws2.receive_bytes())
+                assert frame == {"t": "c", "u": "mover", "x": 120, "y": 45}
+    
+    def test_websocket_msgpack_subprotocol(self, client):
+        """Test that clients negotiating msgpack.dt can send MessagePack frames"""
+        with client.websocket_connect("/ws/msgpack-room?user_id=packer&nickname=Packer",
+                                      subprotocols=["msgpack.dt"]) as ws1:
+            assert ws1.accepted_subprotocol == "msgpack.dt"
+            ws1.receive_json(mode="binary")  # init
             
-            # Send undo
-            ws.send_json({"type": "undo"})
+            with client.websocket_connect("/ws/msgpack-room?user_id=reader&nickname=Reader") as ws2:
+                assert ws2.accepted_subprotocol is None
+                ws2.receive_json(mode="binary")  # init
+                ws1.receive_json(mode="binary")  # user_joined
+                
+                ws1.send_bytes(msgpack.packb({
+                    "type": "stroke",
+                    "id": "packed_stroke",
+                    "points": [{"x": 1.5, "y": 2}],
+                    "color": "#123456",
+                    "size": 3
+                }))
+                
+                data = ws2.receive_json(mode="binary")
+                assert data["type"] == "stroke"
+                assert data["stroke"]["id"] == "packed_stroke"
+                assert data["stroke"]["points"] == [{"x": 1.5, "y": 2}]
+                
+                # Packed points arrive as MessagePack bin and go out as base64
+                packed = struct.pack("<4h", 3, 4, 1, -1)
+                ws1.send_bytes(msgpack.packb({
+                    "type": "stroke",
+                    "id": "int16_stroke",
+                    "points": packed,
+                    "color": "#123456",
+                    "size": 3
+                }))
+                
+                data = ws2.receive_json(mode="binary")
+                assert base64.b64decode(data["stroke"]["points"]) == packed
+    
+    def test_malformed_frames_are_dropped(self, client):
+        """Test that frames that fail to decode or apply don't end the connection"""
+        with client.websocket_connect("/ws/malformed-room?user_id=garbler&nickname=Garbler") as ws:
+            ws.receive_json(mode="binary")  # init
+            ws.send_text("not json")
+            ws.send_json([1, 2])
+            ws.send_json({"type": "stroke", "points": "!!notbase64", "color": "#000", "size": 1})
+            ws.send_json({"type": "stroke", "points": []})  # no color or size
+            ws.send_json({"type": "chat", "text": "still here"})
             
-            # Verify stroke was removed
-            room = manager.room_data.get("undo-test")
-            stroke_ids = [s.id for s in room.strokes] if room else []
-            assert "undo_stroke" not in stroke_ids
+            assert receive_type(ws, "chat")["message"]["text"] == "still here"
+            assert manager.room_data["malformed-room"].strokes == {}
+    
+    def test_failed_connection_leaves_room(self, client, monkeypatch):
+        """Test that an unexpected error still removes the user from the room"""
+        async def crash(*args):
+            raise RuntimeError("handler bug")
+        
+        monkeypatch.setattr(app_module, "handle_message", crash)
+        with pytest.raises(RuntimeError):
+            with client.websocket_connect("/ws/crash-room?user_id=crasher&nickname=Crasher") as ws:
+                ws.receive_json(mode="binary")  # init
+                ws.send_json({"type": "chat", "text": "boom"})
+                ws.receive_json(mode="binary")
+        
+        assert manager.rooms.get("crash-room") in (None, {})
+        assert "crasher" not in manager.user_info
+        assert "crash-room" in manager.idle_rooms(0)
+    
+    def test_websocket_undo(self, room_ws):
+        """Test undo functionality removes stroke"""
+        ws = room_ws["ws-session"]
+        
+        # Send stroke
+        ws.send_json({
+            "type": "stroke",
+            "id": "undo_stroke",
+            "points": [{"x": 0, "y": 0}],
+            "color": "#000",
+            "size": 1,
+            "layer_id": "layer_0"
+        })
+        
+        # Send undo
+        ws.send_json({"type": "undo"})
+        assert receive_type(ws, "remove_stroke")["stroke_id"] == "undo_stroke"
+        
+        # Verify stroke was removed
+        room = manager.room_data.get("ws-session")
+        assert "undo_stroke" not in room.strokes
     
-    def test_websocket_add_layer(self, client):
+    def test_websocket_add_layer(self, room_ws):
         """Test adding a new layer"""
-        import time
-        with client.websocket_connect("/ws/layer-test?user_id=layer-user&nickname=Layerer") as ws:
-            ws.receive_json()  # init
-            
-            # Add layer
-            ws.send_json({
-                "type": "add_layer",
-                "id": "new_layer_123",
-                "name": "My Custom Layer"
-            })
-            
-            # Wait for message processing
-            time.sleep(0.1)
-            
-            # Verify layer was added
-            room = manager.room_data.get("layer-test")
-            layer_ids = [l.id for l in room.layers] if room else []
-            assert "new_layer_123" in layer_ids
+        ws = room_ws["ws-session"]
+        
+        # Add layer
+        ws.send_json({
+            "type": "add_layer",
+            "id": "new_layer_123",
+            "name": "My Custom Layer"
+        })
+        receive_type(ws, "layer_added")
+        
+        # Verify layer was added
+        room = manager.room_data.get("ws-session")
+        layer_ids = [l.id for l in room.layers] if room else []
+        assert "new_layer_123" in layer_ids
     
-    def test_websocket_clear_layer(self, client):
+    def test_websocket_clear_layer(self, room_ws):
         """Test clearing a layer removes its strokes"""
-        with client.websocket_connect("/ws/clear-test?user_id=clear-user&nickname=Clearer") as ws:
-            ws.receive_json()  # init
-            
-            # Add stroke
-            ws.send_json({
-                "type": "stroke",
-                "id": "stroke_to_clear",
-                "points": [{"x": 50, "y": 50}],
-                "color": "#000",
-                "size": 1,
-                "layer_id": "layer_0"
-            })
-            
-            # Clear layer
-            ws.send_json({
-                "type": "clear_layer",
-                "layer_id": "layer_0"
-            })
-            
-            # Verify strokes are cleared
-            room = manager.room_data.get("clear-test")
-            layer0_strokes = [s for s in room.strokes if s.layer_id == "layer_0"] if room else []
-            assert len(layer0_strokes) == 0
+        ws = room_ws["ws-session"]
+        
+        # Add stroke
+        ws.send_json({
+            "type": "stroke",
+            "id": "stroke_to_clear",
+            "points": [{"x": 50, "y": 50}],
+            "color": "#000",
+            "size": 1,
+            "layer_id": "layer_0"
+        })
+        
+        # Clear layer
+        ws.send_json({
+            "type": "clear_layer",
+            "layer_id": "layer_0"
+        })
+        receive_type(ws, "layer_cleared")
+        
+        # Verify strokes are cleared
+        room = manager.room_data.get("ws-session")
+        layer0_strokes = [s for s in room.strokes.values() if s.layer_id == "layer_0"] if room else []
+        assert len(layer0_strokes) == 0
 
 
 class TestRoomPersistence:
@@ -190,7 +297,7 @@ class TestRoomPersistence:
         """Test that room can be saved after drawing"""
         # First create room with strokes
         with client.websocket_connect("/ws/save-test?user_id=saver&nickname=Saver") as ws:
-            ws.receive_json()  # init
+            ws.receive_json(mode="binary")  # init
             
             ws.send_json({
                 "type": "stroke",
@@ -205,4 +312,194 @@ class TestRoomPersistence:
         response = client.post("/api/rooms/save-test/save")
         assert response.status_code == 200
         assert response.json()["status"] == "saved"
-
+    
+    def test_evicted_room_reloads_from_db(self, client):
+        """Test that an idle room is unloaded and restored on the next join"""
+        with client.websocket_connect("/ws/evict-test?user_id=evicter&nickname=Evicter") as ws:
+            ws.receive_json(mode="binary")  # init
+            ws.send_json({
+                "type": "stroke",
+                "id": "kept_stroke",
+                "points": [{"x": 5, "y": 5}],
+                "color": "#000",
+                "size": 1,
+                "layer_id": "layer_0"
+            })
+        
+        manager.idle_since["evict-test"] = 0
+        asyncio.run(evict_idle_rooms())
+        assert "evict-test" not in manager.room_data
+        
+        with client.websocket_connect("/ws/evict-test?user_id=evicter&nickname=Evicter") as ws:
+            init = ws.receive_json(mode="binary")
+            assert [s["id"] for s in init["room"]["strokes"]] == ["kept_stroke"]
+    
+    async def test_autosave_flushes_dirty_rooms(self):
+        """Test that the debounced autosave writes mutated rooms"""
+        manager.room_data["autosave-test"] = Room(id="autosave-test", name="autosave-test")
+        manager.add_layer("autosave-test", Layer(id="layer_1", name="Sketch", order=1))
+        
+        await flush_dirty_rooms()
+        
+        assert "autosave-test" not in manager.dirty_rooms
+        saved = await load_room("autosave-test")
+        assert saved is not None
+        assert [l.id for l in saved.layers] == ["layer_1"]
+    
+    async def test_failed_manual_save_is_retried(self, monkeypatch):
+        """Test that a failed save endpoint write leaves the room and strokes queued"""
+        manager.room_data["retry-test"] = Room(id="retry-test", name="retry-test")
+        manager.add_stroke("retry-test", Stroke(
+            id="s1", user_id="u1", points=[{"x": 1, "y": 1}],
+            color="#000", size=1, layer_id="layer_0", timestamp=1.0
+        ))
+        
+        async def fail(*args):
+            raise RuntimeError("database is locked")
+        
+        monkeypatch.setattr(app_module, "save_stroke_changes", fail)
+        with pytest.raises(RuntimeError):
+            await app_module.save_room_endpoint("retry-test")
+        assert "s1" in manager.pending_strokes["retry-test"]
+        
+        monkeypatch.setattr(app_module, "save_room", fail)
+        manager.dirty_rooms.add("retry-test")
+        with pytest.raises(RuntimeError):
+            await app_module.save_room_endpoint("retry-test")
+        assert "retry-test" in manager.dirty_rooms
+        assert "s1" in manager.pending_strokes["retry-test"]
+    
+    async def test_periodic_flush_failure_is_logged(self, caplog):
+        """Test a failing background flush is logged and retried, not swallowed"""
+        calls = []
+        
+        async def fail():
+            calls.append(1)
+            raise RuntimeError("disk full")
+        
+        task = asyncio.create_task(app_module._run_periodically(0, fail))
+        while len(calls) < 2:
+            await asyncio.sleep(0)
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        
+        assert "fail failed" in caplog.text
+        assert "disk full" in caplog.text
+    
+    async def test_shutdown_closes_db_when_final_flush_fails(self, monkeypatch):
+        """Test the lifespan still closes the connection if the last flush raises"""
+        async def fail():
+            raise RuntimeError("database is locked")
+        
+        monkeypatch.setattr(app_module, "flush_dirty_rooms", fail)
+        with pytest.raises(RuntimeError):
+            async with app_module.lifespan(app):
+                pass
+        assert app_module.db_conn is None
+    
+    async def test_strokes_persisted_incrementally(self):
+        """Test that added and undone strokes are reflected in the strokes table"""
+        manager.room_data["stroke-db-test"] = Room(id="stroke-db-test", name="stroke-db-test")
+        for i in range(3):
+            manager.add_stroke("stroke-db-test", Stroke(
+                id=f"s{i}", user_id="u1", points=[{"x": i, "y": i}],
+                color="#000", size=1, layer_id="layer_0", timestamp=float(i)
+            ))
+        await flush_dirty_rooms()
+        
+        manager.remove_last_stroke("stroke-db-test", "u1")
+        await flush_dirty_rooms()
+        
+        saved = await load_room("stroke-db-test")
+        assert list(saved.strokes) == ["s0", "s1"]
+        assert saved.strokes["s1"].points == [{"x": 1, "y": 1}]
+    
+    async def test_stroke_points_stored_compressed(self, line_points):
+        """Test that long strokes hit the disk as zstd and load back unchanged"""
+        points = list(line_points(500))
+        manager.room_data["zstd-test"] = Room(id="zstd-test", name="zstd-test")
+        manager.add_stroke("zstd-test", Stroke(
+            id="long", user_id="u1", points=points,
+            color="#000", size=1, layer_id="layer_0", timestamp=1.0
+        ))
+        await flush_dirty_rooms()
+        
+        cursor = await app_module.db_conn.execute("SELECT points FROM strokes WHERE id = 'long'")
+        (blob,) = await cursor.fetchone()
+        assert blob.startswith(app_module._ZSTD_MAGIC)
+        assert len(blob) < len(json.dumps(points)) / 4
+        
+        saved = await load_room("zstd-test")
+        assert saved.strokes["long"].points == points
+    
+    async def test_uncompressed_legacy_rows_still_load(self):
+        """Test that plain JSON written before compression is still readable"""
+        await app_module.db_conn.execute(
+            "INSERT INTO rooms (id, name, data) VALUES (?, ?, ?)",
+            ("legacy-json", "legacy-json", json.dumps({"layers": [{"id": "layer_0", "name": "Background"}]}))
+        )
+        await app_module.db_conn.execute(
+            "INSERT INTO strokes (room_id, id, user_id, layer_id, color, size, points, tool, ts) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            ("legacy-json", "old", "u1", "layer_0", "#000", 1, b'[{"x":1,"y":2}]', "brush", 1.0)
+        )
+        await app_module.db_conn.commit()
+        
+        saved = await load_room("legacy-json")
+        assert saved.strokes["old"].points == [{"x": 1, "y": 2}]
+    
+    async def test_packed_points_persisted(self):
+        """Test packed points survive a flush and reload unchanged"""
+        packed = struct.pack("<6h", 100, 200, 1, 1, -2, 0)
+        manager.room_data["packed-db-test"] = Room(id="packed-db-test", name="packed-db-test")
+        manager.add_stroke("packed-db-test", Stroke(
+            id="p1", user_id="u1", points=packed,
+            color="#000", size=1, layer_id="layer_0", timestamp=1.0
+        ))
+        await flush_dirty_rooms()
+        
+        cursor = await app_module.db_conn.execute("SELECT points FROM strokes WHERE id = 'p1'")
+        assert (await cursor.fetchone())[0] == app_module._PACKED_POINTS + packed
+        
+        saved = await load_room("packed-db-test")
+        assert saved.strokes["p1"].points == packed
+    
+    async def test_base64_packed_rows_still_load(self):
+        """Test packed points stored as a base64 JSON string still load as bytes"""
+        packed = struct.pack("<4h", 5, 6, 1, -1)
+        await app_module.db_conn.execute(
+            "INSERT INTO strokes (room_id, id, user_id, layer_id, color, size, points, tool, ts) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            ("b64-room", "old", "u1", "layer_0", "#000", 1, json.dumps(base64.b64encode(packed).decode()).encode(), "brush", 1.0)
+        )
+        await app_module.db_conn.commit()
+        
+        strokes = await app_module.load_strokes("b64-room")
+        assert strokes[0].points == packed
+    
+    async def test_legacy_hex_password_hash_still_matches(self):
+        """Test that hex digests written by older versions load as raw digests"""
+        await app_module.db_conn.execute(
+            "INSERT INTO rooms (id, name, data, password_hash) VALUES (?, ?, ?, ?)",
+            ("legacy-pw", "legacy-pw", b"{}", hashlib.sha256(b"secret").hexdigest())
+        )
+        await app_module.db_conn.commit()
+        
+        saved = await load_room("legacy-pw")
+        assert saved.password_hash == hashlib.sha256(b"secret").digest()
+    
+    async def test_three_column_schema_migrated(self):
+        """Test that init_db adds missing columns to a first-version rooms table"""
+        await app_module.close_db()
+        await app_module.init_db()
+        await app_module.db_conn.execute("DROP TABLE rooms")
+        await app_module.db_conn.execute("CREATE TABLE rooms (id TEXT PRIMARY KEY, name TEXT, data TEXT)")
+        await app_module.db_conn.execute(
+            "INSERT INTO rooms (id, name, data) VALUES (?, ?, ?)", ("v1-room", "Old Room", "{}")
+        )
+        await app_module.db_conn.commit()
+        await app_module.close_db()
+        await app_module.init_db()
+        
+        saved = await load_room("v1-room")
+        assert saved.name == "Old Room"
+        assert saved.password_hash is None
+        assert saved.created_at > 0
@@ -6,11 +6,23 @@ Tests the core WebSocket connection management logic
 import pytest
 from unittest.mock import AsyncMock, MagicMock
 import asyncio
+import hashlib
+import json
 
-import sys
-sys.path.insert(0, '..')
+from tests.conftest import FakeWS
+from app import ConnectionManager, Outbox, Stroke, Layer, Room, ChatMessage, CHAT_HISTORY, hash_password
 
-from app import ConnectionManager, Stroke, Layer, Room
+
+def outboxes(**sockets):
+    """Started outboxes keyed by user id, as connect() would register them"""
+    registered = {uid: Outbox(ws) for uid, ws in sockets.items()}
+    for outbox in registered.values():
+        outbox.start()
+    return registered
+
+
+async def drain(manager, room_id):
+    await asyncio.gather(*(o.drain() for o in list(manager.rooms[room_id].values())))
 
 
 class TestConnectionManager:
@@ -18,7 +30,11 @@ class TestConnectionManager:
     
     @pytest.fixture
     def manager(self):
-        return ConnectionManager()
+        manager = ConnectionManager()
+        yield manager
+        for users in manager.rooms.values():
+            for outbox in users.values():
+                outbox.close()
     
     @pytest.fixture
     def mock_websocket(self):
@@ -27,7 +43,6 @@ class TestConnectionManager:
         ws.send_json = AsyncMock()
         return ws
     
-    @pytest.mark.asyncio
     async def test_connect_creates_room(self, manager, mock_websocket):
         """Test that connecting to a new room creates it"""
         await manager.connect(mock_websocket, "room1", "user1", "Alice")
@@ -36,7 +51,6 @@ class TestConnectionManager:
         assert "user1" in manager.rooms["room1"]
         assert "room1" in manager.room_data
     
-    @pytest.mark.asyncio
     async def test_connect_multiple_users_same_room(self, manager, mock_websocket):
         """Test multiple users can join same room"""
         ws1 = AsyncMock()
@@ -49,16 +63,183 @@ class TestConnectionManager:
         assert "user1" in manager.rooms["room1"]
         assert "user2" in manager.rooms["room1"]
     
-    @pytest.mark.asyncio
     async def test_connect_sends_init_state(self, manager, mock_websocket):
         """Test that connecting sends initial room state"""
         await manager.connect(mock_websocket, "room1", "user1", "Alice")
         
-        mock_websocket.send_json.assert_called()
-        call_args = mock_websocket.send_json.call_args[0][0]
+        mock_websocket.send_bytes.assert_called()
+        call_args = json.loads(mock_websocket.send_bytes.call_args[0][0])
         assert call_args["type"] == "init"
         assert "room" in call_args
         assert "users" in call_args
+        assert call_args["room"]["layers"][0]["id"] == "layer_0"
+    
+    async def test_failed_init_send_unregisters_user(self, manager):
+        """Test that a socket dropping before init arrives doesn't stay in the room"""
+        ws = AsyncMock()
+        ws.send_bytes.side_effect = RuntimeError("connection closed")
+        
+        with pytest.raises(RuntimeError):
+            await manager.connect(ws, "room1", "user1", "Alice")
+        
+        assert manager.rooms["room1"] == {}
+        assert "user1" not in manager.user_info
+        assert "room1" in manager.idle_rooms(0)
+    
+    async def test_init_snapshot_rebuilt_after_stroke(self, manager):
+        """Test that the cached init snapshot picks up new strokes"""
+        ws1 = AsyncMock()
+        ws2 = AsyncMock()
+        
+        await manager.connect(ws1, "room1", "user1", "Alice")
+        snapshot = manager.get_room_snapshot("room1")
+        assert manager.get_room_snapshot("room1") is snapshot
+        
+        manager.add_stroke("room1", Stroke(
+            id="s1", user_id="user1", points=[{"x": 1, "y": 2}],
+            color="#000", size=1, layer_id="layer_0", timestamp=1.0
+        ))
+        await manager.connect(ws2, "room1", "user2", "Bob")
+        
+        init = json.loads(ws2.send_bytes.call_args[0][0])
+        assert [s["id"] for s in init["room"]["strokes"]] == ["s1"]
+        assert init["room"]["strokes"][0]["points"] == [{"x": 1, "y": 2}]
+    
+    async def test_snapshot_follows_room_revision(self, manager):
+        """Test that joins share one snapshot until a layer or stroke change"""
+        await manager.connect(AsyncMock(), "room1", "user1", "Alice")
+        snapshot = manager.get_room_snapshot("room1")
+        await manager.connect(AsyncMock(), "room1", "user2", "Bob")
+        assert manager.get_room_snapshot("room1") is snapshot
+        
+        manager.add_layer("room1", Layer(id="layer_1", name="Sketch", order=1))
+        
+        layers = json.loads(manager.get_room_snapshot("room1"))["layers"]
+        assert [l["id"] for l in layers] == ["layer_0", "layer_1"]
+    
+    async def test_snapshot_reuses_encoded_strokes(self, manager):
+        """Test that a rebuilt snapshot only encodes strokes it hasn't seen"""
+        await manager.connect(AsyncMock(), "room1", "user1", "Alice")
+        s1 = Stroke(id="s1", user_id="user1", points=[{"x": 1, "y": 1}],
+                    color="#000", size=1, layer_id="layer_0", timestamp=1.0)
+        manager.add_stroke("room1", s1)
+        manager.get_room_snapshot("room1")
+        encoded = manager.stroke_json["room1"]["s1"]
+        
+        manager.add_stroke("room1", Stroke(id="s2", user_id="user1", points=[],
+                                           color="#000", size=1, layer_id="layer_0", timestamp=2.0))
+        snapshot = json.loads(manager.get_room_snapshot("room1"))
+        
+        assert manager.stroke_json["room1"]["s1"] is encoded
+        assert [s["id"] for s in snapshot["strokes"]] == ["s1", "s2"]
+        
+        # Re-sending an id (redo) replaces its encoding
+        manager.add_stroke("room1", Stroke(id="s1", user_id="user1", points=[{"x": 9, "y": 9}],
+                                           color="#000", size=1, layer_id="layer_0", timestamp=3.0))
+        snapshot = json.loads(manager.get_room_snapshot("room1"))
+        assert [s["id"] for s in snapshot["strokes"]] == ["s2", "s1"]
+        assert snapshot["strokes"][1]["points"] == [{"x": 9, "y": 9}]
+    
+    async def test_reconnect_with_since_gets_only_changes(self, manager):
+        """Test that a client passing its last revision receives a delta"""
+        def stroke(sid):
+            return Stroke(id=sid, user_id="user1", points=[], color="#000",
+                          size=1, layer_id="layer_0", timestamp=1.0)
+        
+        ws1 = AsyncMock()
+        await manager.connect(ws1, "room1", "user1", "Alice")
+        manager.add_stroke("room1", stroke("s1"))
+        manager.add_stroke("room1", stroke("s2"))
+        log = manager.stroke_logs["room1"]
+        since = f"{log.epoch}:{log.rev}"
+        
+        manager.add_stroke("room1", stroke("s3"))
+        manager.remove_last_stroke("room1", "user1")
+        manager.remove_last_stroke("room1", "user1")
+        manager.add_stroke("room1", stroke("s4"))
+        
+        ws2 = AsyncMock()
+        await manager.connect(ws2, "room1", "user2", "Bob", since=since)
+        room = json.loads(ws2.send_bytes.call_args[0][0])["room"]
+        assert room["since"] == log.rev - 4
+        assert [s["id"] for s in room["strokes"]] == ["s4"]
+        assert room["removed_stroke_ids"] == ["s3", "s2"]
+        assert room["rev"] == log.rev
+    
+    async def test_reconnect_with_stale_epoch_gets_full_snapshot(self, manager):
+        """Test that revisions from another room lifetime fall back to a snapshot"""
+        await manager.connect(AsyncMock(), "room1", "user1", "Alice")
+        manager.add_stroke("room1", Stroke(
+            id="s1", user_id="user1", points=[], color="#000",
+            size=1, layer_id="layer_0", timestamp=1.0
+        ))
+        
+        ws = AsyncMock()
+        await manager.connect(ws, "room1", "user2", "Bob", since="oldepoch:1")
+        
+        room = json.loads(ws.send_bytes.call_args[0][0])["room"]
+        assert "since" not in room
+        assert [s["id"] for s in room["strokes"]] == ["s1"]
+    
+    async def test_legacy_sha256_password_upgraded_on_join(self, manager):
+        """Test that SHA-256 protected rooms still accept their password and move to BLAKE2b"""
+        manager.room_data["room1"] = Room(id="room1", name="Room 1",
+                                          password_hash=hashlib.sha256(b"secret").digest())
+        
+        assert await manager.connect(AsyncMock(), "room1", "user1", "Alice", "wrong") is False
+        assert await manager.connect(AsyncMock(), "room1", "user2", "Bob", "secret") is True
+        
+        assert manager.room_data["room1"].password_hash == hash_password("secret")
+        assert "room1" in manager.dirty_rooms
+    
+    async def test_restored_room_ages_out_after_rejected_join(self, manager):
+        """Test a room loaded for a join that is turned away still gets an idle TTL"""
+        manager.restore_room(Room(id="room1", name="Room 1", password_hash=hash_password("secret")))
+        
+        assert await manager.connect(AsyncMock(), "room1", "intruder", "Eve", "wrong") is False
+        assert "room1" in manager.idle_rooms(0)
+        
+        assert await manager.connect(AsyncMock(), "room1", "user1", "Alice", "secret") is True
+        assert "room1" not in manager.idle_since
+    
+    async def test_concurrent_restore_keeps_loaded_room(self, manager):
+        """Test a second DB load of the same room doesn't replace the one in use"""
+        assert manager.restore_room(Room(id="room1", name="Room 1")) is True
+        await manager.connect(AsyncMock(), "room1", "user1", "Alice")
+        manager.add_stroke("room1", Stroke(id="s1", user_id="user1", points=[], color="#000",
+                                           size=1, layer_id="layer_0", timestamp=0))
+        epoch = manager.stroke_logs["room1"].epoch
+        
+        assert manager.restore_room(Room(id="room1", name="Room 1")) is False
+        assert list(manager.room_data["room1"].strokes) == ["s1"]
+        assert manager.stroke_logs["room1"].epoch == epoch
+        assert manager.user_stroke_ids["room1"] == {"user1": ["s1"]}
+        assert manager.room_stats["room1"].active_users == 1
+    
+    async def test_room_pinned_while_accept_in_flight(self, manager):
+        """Test eviction can't drop a protected room mid-accept and let a wrong password in"""
+        manager.room_data["room1"] = Room(id="room1", name="Room 1", password_hash=hash_password("secret"),
+                                          layers=[Layer(id="ink", name="Ink")])
+        manager.idle_since["room1"] = 0.0
+        release = asyncio.Event()
+        ws = AsyncMock()
+        
+        async def slow_accept(subprotocol=None):
+            await release.wait()
+        
+        ws.accept.side_effect = slow_accept
+        joining = asyncio.create_task(manager.connect(ws, "room1", "intruder", "Eve", "wrong"))
+        await asyncio.sleep(0)
+        
+        assert manager.evict_room("room1") is False
+        assert manager.overflow_rooms(0) == []
+        release.set()
+        
+        assert await joining is False
+        assert [l.id for l in manager.room_data["room1"].layers] == ["ink"]
+        assert manager.room_data["room1"].password_hash == hash_password("secret")
+        assert manager.joining == {}
+        assert manager.evict_room("room1") is True
     
     def test_disconnect_removes_user(self, manager):
         """Test that disconnecting removes user from room"""
@@ -108,7 +289,7 @@ class TestConnectionManager:
         manager.add_stroke("room1", stroke)
         
         assert len(manager.room_data["room1"].strokes) == 1
-        assert manager.room_data["room1"].strokes[0].id == "s1"
+        assert manager.room_data["room1"].strokes["s1"].id == "s1"
     
     def test_remove_last_stroke_by_user(self, manager):
         """Test removing the last stroke made by a specific user"""
@@ -118,17 +299,52 @@ class TestConnectionManager:
         stroke2 = Stroke(id="s2", user_id="user2", points=[], color="#000", size=1, layer_id="l0", timestamp=2.0)
         stroke3 = Stroke(id="s3", user_id="user1", points=[], color="#000", size=1, layer_id="l0", timestamp=3.0)
         
-        manager.room_data["room1"].strokes = [stroke1, stroke2, stroke3]
+        for stroke in (stroke1, stroke2, stroke3):
+            manager.add_stroke("room1", stroke)
         
         removed = manager.remove_last_stroke("room1", "user1")
         
         assert removed.id == "s3"
         assert len(manager.room_data["room1"].strokes) == 2
         # stroke1 should still be there
-        remaining_ids = [s.id for s in manager.room_data["room1"].strokes]
+        remaining_ids = list(manager.room_data["room1"].strokes)
         assert "s1" in remaining_ids
         assert "s2" in remaining_ids
     
+    def test_undo_walks_user_history_back(self, manager):
+        """Test repeated undo pops the user's strokes newest first, skipping cleared ones"""
+        manager.room_data["room1"] = Room(id="room1", name="Room 1")
+        for i, layer_id in enumerate(["layer_0", "layer_1", "layer_0"]):
+            manager.add_stroke("room1", Stroke(
+                id=f"s{i}", user_id="user1", points=[], color="#000",
+                size=1, layer_id=layer_id, timestamp=float(i)
+            ))
+        manager.add_stroke("room1", Stroke(
+            id="other", user_id="user2", points=[], color="#000",
+            size=1, layer_id="layer_0", timestamp=9.0
+        ))
+        
+        manager.clear_layer("room1", "layer_1")
+        
+        assert manager.remove_last_stroke("room1", "user1").id == "s2"
+        assert manager.remove_last_stroke("room1", "user1").id == "s0"
+        assert manager.remove_last_stroke("room1", "user1") is None
+        assert list(manager.room_data["room1"].strokes) == ["other"]
+    
+    def test_redo_moves_stroke_to_end(self, manager):
+        """Test that re-sending an undone stroke id puts it back on top"""
+        manager.room_data["room1"] = Room(id="room1", name="Room 1")
+        s1 = Stroke(id="s1", user_id="user1", points=[], color="#000", size=1, layer_id="l0", timestamp=1.0)
+        s2 = Stroke(id="s2", user_id="user2", points=[], color="#000", size=1, layer_id="l0", timestamp=2.0)
+        manager.add_stroke("room1", s1)
+        manager.add_stroke("room1", s2)
+        
+        manager.remove_last_stroke("room1", "user1")
+        manager.add_stroke("room1", s1)
+        
+        assert list(manager.room_data["room1"].strokes) == ["s2", "s1"]
+        assert manager.remove_last_stroke("room1", "user1").id == "s1"
+    
     def test_add_layer(self, manager):
         """Test adding a layer to room"""
         manager.room_data["room1"] = Room(id="room1", name="Room 1")
@@ -147,38 +363,228 @@ class TestConnectionManager:
         stroke2 = Stroke(id="s2", user_id="u1", points=[], color="#000", size=1, layer_id="layer_1", timestamp=2.0)
         stroke3 = Stroke(id="s3", user_id="u1", points=[], color="#000", size=1, layer_id="layer_0", timestamp=3.0)
         
-        manager.room_data["room1"].strokes = [stroke1, stroke2, stroke3]
+        for stroke in (stroke1, stroke2, stroke3):
+            manager.add_stroke("room1", stroke)
         
         manager.clear_layer("room1", "layer_0")
         
         assert len(manager.room_data["room1"].strokes) == 1
-        assert manager.room_data["room1"].strokes[0].layer_id == "layer_1"
+        assert manager.room_data["room1"].strokes["s2"].layer_id == "layer_1"
+    
+    def test_mutations_mark_room_dirty(self, manager):
+        """Test that mutating a room queues it for the next autosave"""
+        manager.room_data["room1"] = Room(id="room1", name="Room 1")
+        assert manager.dirty_rooms == set()
+        
+        manager.add_layer("room1", Layer(id="layer_1", name="New Layer", order=1))
+        
+        assert manager.dirty_rooms == {"room1"}
+    
+    def test_chat_history_is_bounded(self, manager):
+        """Test that only the newest CHAT_HISTORY messages are kept"""
+        manager.room_data["room1"] = Room(id="room1", name="Room 1")
+        for i in range(CHAT_HISTORY + 5):
+            manager.add_chat_message("room1", ChatMessage(
+                id=f"m{i}", user_id="user1", nickname="Alice", text=str(i), timestamp=float(i)
+            ))
+        
+        messages = manager.room_data["room1"].chat_messages
+        assert len(messages) == CHAT_HISTORY
+        assert messages[0].id == "m5"
+        assert messages[-1].id == f"m{CHAT_HISTORY + 4}"
+    
+    def test_evict_idle_room(self, manager):
+        """Test that only empty, flushed rooms past the idle TTL are evicted"""
+        manager.rooms["room1"] = {"user1": MagicMock()}
+        manager.user_info["user1"] = {"nickname": "Alice", "room_id": "room1"}
+        manager.room_data["room1"] = Room(id="room1", name="Room 1")
+        
+        assert manager.idle_rooms(0) == []
+        manager.disconnect("room1", "user1")
+        assert manager.idle_rooms(0) == ["room1"]
+        assert manager.idle_rooms(3600) == []
+        
+        manager.dirty_rooms.add("room1")
+        assert manager.evict_room("room1") is False
+        
+        manager.dirty_rooms.clear()
+        assert manager.evict_room("room1") is True
+        assert "room1" not in manager.room_data
+        assert "room1" not in manager.rooms
+    
+    def test_overflow_rooms_are_least_recently_used_empty_ones(self, manager):
+        """Test that the LRU cap skips occupied rooms and picks the oldest empty ones"""
+        for rid in ("a", "b", "c", "d"):
+            manager.room_data[rid] = Room(id=rid, name=rid)
+        manager.rooms["a"] = {"user1": MagicMock()}
+        manager.user_info["user1"] = {"nickname": "Alice", "room_id": "a"}
+        
+        assert manager.overflow_rooms(4) == []
+        assert manager.overflow_rooms(2) == ["b", "c"]
+        
+        # The room its last user just left becomes the most recently used
+        manager.disconnect("a", "user1")
+        manager.rooms["b"] = {"user2": MagicMock()}
+        assert manager.overflow_rooms(2) == ["c", "d"]
     
-    @pytest.mark.asyncio
     async def test_broadcast_to_all_except_sender(self, manager):
         """Test broadcasting message to all users except sender"""
-        ws1 = AsyncMock()
-        ws2 = AsyncMock()
-        ws3 = AsyncMock()
+        ws1 = FakeWS()
+        ws2 = FakeWS()
+        ws3 = FakeWS()
         
-        manager.rooms["room1"] = {"user1": ws1, "user2": ws2, "user3": ws3}
+        manager.rooms["room1"] = outboxes(user1=ws1, user2=ws2, user3=ws3)
         
         await manager.broadcast("room1", {"type": "test"}, exclude="user1")
+        await drain(manager, "room1")
         
-        ws1.send_json.assert_not_called()
-        ws2.send_json.assert_called_once_with({"type": "test"})
-        ws3.send_json.assert_called_once_with({"type": "test"})
+        assert ws1.sent == []
+        assert ws2.sent == [b'{"type":"test"}']
+        assert ws3.sent == [b'{"type":"test"}']
     
-    @pytest.mark.asyncio
     async def test_broadcast_to_all(self, manager):
         """Test broadcasting to all users including sender"""
+        ws1 = FakeWS()
+        ws2 = FakeWS()
+        
+        manager.rooms["room1"] = outboxes(user1=ws1, user2=ws2)
+        
+        await manager.broadcast("room1", {"type": "test"})
+        await drain(manager, "room1")
+        
+        assert len(ws1.sent) == 1
+        assert len(ws2.sent) == 1
+    
+    async def test_broadcast_bytes_sends_payload_unchanged(self, manager):
+        """Test that a pre-encoded frame reaches every peer as-is"""
+        ws1 = FakeWS()
+        ws2 = FakeWS()
+        
+        manager.rooms["room1"] = outboxes(user1=ws1, user2=ws2)
+        
+        await manager.broadcast_bytes("room1", b'{"type":"cursor"}', exclude="user1")
+        await drain(manager, "room1")
+        
+        assert ws1.sent == []
+        assert ws2.sent == [b'{"type":"cursor"}']
+    
+    async def test_broadcast_drops_failed_sockets(self, manager):
+        """Test that a failing send disconnects only that user"""
         ws1 = AsyncMock()
         ws2 = AsyncMock()
+        ws2.send_bytes.side_effect = RuntimeError("connection closed")
         
-        manager.rooms["room1"] = {"user1": ws1, "user2": ws2}
+        manager.rooms["room1"] = outboxes(user1=ws1, user2=ws2)
+        for uid, outbox in manager.rooms["room1"].items():
+            outbox.on_error = lambda uid=uid: manager.disconnect("room1", uid)
+        manager.user_info["user1"] = {"nickname": "Alice", "room_id": "room1"}
+        manager.user_info["user2"] = {"nickname": "Bob", "room_id": "room1"}
         
         await manager.broadcast("room1", {"type": "test"})
+        await drain(manager, "room1")
         
-        ws1.send_json.assert_called_once()
-        ws2.send_json.assert_called_once()
-
+        ws1.send_bytes.assert_called_once()
+        assert "user1" in manager.rooms["room1"]
+        assert "user2" not in manager.rooms["room1"]
+    
+    async def test_slow_client_does_not_block_broadcast(self, manager):
+        """Test that broadcast returns while a peer's send is still pending"""
+        release = asyncio.Event()
+        slow = AsyncMock()
+        
+        async def stall(payload):
+            await release.wait()
+        
+        slow.send_bytes.side_effect = stall
+        fast = AsyncMock()
+        
+        manager.rooms["room1"] = outboxes(slow=slow, fast=fast)
+        
+        await asyncio.wait_for(manager.broadcast("room1", {"type": "test"}), 1)
+        await manager.rooms["room1"]["fast"].drain()
+        
+        fast.send_bytes.assert_called_once()
+        release.set()
+        await drain(manager, "room1")
+    
+    async def test_stalled_client_cut_off_at_max_queue(self, manager):
+        """Test that a client that stops reading is disconnected, not buffered forever"""
+        never = asyncio.Event()
+        stalled = AsyncMock()
+        
+        async def stall(payload):
+            await never.wait()
+        
+        stalled.send_bytes.side_effect = stall
+        reader = FakeWS()
+        
+        manager.rooms["room1"] = outboxes(stalled=stalled, reader=reader)
+        for uid, outbox in manager.rooms["room1"].items():
+            outbox.on_error = lambda uid=uid, outbox=outbox: manager._drop_outbox("room1", uid, outbox)
+        manager.user_info["stalled"] = {"nickname": "Slow", "room_id": "room1"}
+        manager.user_info["reader"] = {"nickname": "Fast", "room_id": "room1"}
+        backlog = manager.rooms["room1"]["stalled"]
+        
+        # The first frame is stuck in send_bytes; the rest pile up behind it
+        for i in range(Outbox.MAX_QUEUE + 2):
+            await manager.broadcast_bytes("room1", b"stroke%d" % i)
+            await asyncio.sleep(0)  # let the readers' writers run, as between received frames
+        await drain(manager, "room1")
+        await asyncio.sleep(0)  # the socket close is its own task
+        
+        assert list(manager.rooms["room1"]) == ["reader"]
+        assert len(backlog) == 0
+        stalled.close.assert_awaited_once_with(code=1013)
+        assert len(reader.sent) == Outbox.MAX_QUEUE + 3
+        assert json.loads(reader.sent[-1])["type"] == "user_left"
+    
+    async def test_backed_up_outbox_coalesces_cursor_frames(self, manager):
+        """Test that only the newest cursor per user survives a backlog"""
+        ws = FakeWS()
+        outbox = Outbox(ws)  # not started, so frames pile up
+        manager.rooms["room1"] = {"user1": outbox}
+        
+        for i in range(Outbox.COALESCE_THRESHOLD + 1):
+            await manager.broadcast_bytes("room1", b"stroke%d" % i)
+        for i in range(5):
+            await manager.broadcast_bytes("room1", b"cursor%d" % i, coalesce_key="cursor:user2")
+        
+        outbox.start()
+        await outbox.drain()
+        
+        strokes = [b"stroke%d" % i for i in range(Outbox.COALESCE_THRESHOLD + 1)]
+        assert ws.sent == strokes + [b"cursor4"]
+    
+    async def test_backed_up_json_events_sent_as_one_batch(self, manager):
+        """Test that queued JSON events are spliced into a single batch frame"""
+        ws = FakeWS()
+        outbox = Outbox(ws)
+        manager.rooms["room1"] = {"user1": outbox}
+        
+        for i in range(3):
+            await manager.broadcast("room1", {"type": "stroke", "n": i})
+        await manager.broadcast_bytes("room1", b"\x84compact")
+        await manager.broadcast("room1", {"type": "chat"})
+        
+        outbox.start()
+        await outbox.drain()
+        
+        sent = ws.sent
+        assert json.loads(sent[0]) == {"type": "batch", "events": [
+            {"type": "stroke", "n": 0}, {"type": "stroke", "n": 1}, {"type": "stroke", "n": 2}
+        ]}
+        assert sent[1:] == [b"\x84compact", b'{"type":"chat"}']
+    
+    async def test_cursor_moves_are_rate_limited_to_latest(self, manager):
+        """Test that rapid cursor moves send the first at once and only the newest after"""
+        ws = FakeWS()
+        manager.rooms["room1"] = outboxes(mover=FakeWS(), watcher=ws)
+        
+        for i in range(5):
+            manager.send_cursor("room1", "mover", b"pos%d" % i)
+        await drain(manager, "room1")
+        assert ws.sent == [b"pos0"]
+        
+        await asyncio.sleep(ConnectionManager.CURSOR_INTERVAL * 2)
+        await drain(manager, "room1")
+        assert ws.sent == [b"pos0", b"pos4"]
@@ -4,12 +4,11 @@ TDD approach - tests written based on BDD specifications
 """
 
 import pytest
+import base64
+import struct
 from dataclasses import asdict
 
-import sys
-sys.path.insert(0, '..')
-
-from app import Stroke, Layer, Room
+from app import Stroke, Layer, Room, ChatMessage, CHAT_REPLAY, decode_points
 
 
 class TestStrokeModel:
@@ -52,9 +51,34 @@ class TestStrokeModel:
         assert data["points"] == [{"x": 10, "y": 20}]
         assert "timestamp" in data
     
-    def test_stroke_with_multiple_points(self):
+    def test_stroke_to_dict_matches_asdict(self):
+        """Test the hand-written to_dict agrees with dataclasses.asdict"""
+        stroke = Stroke(
+            id="stroke_1",
+            user_id="user_1",
+            points=[{"x": 10, "y": 20}],
+            color="#000000",
+            size=3,
+            layer_id="layer_0",
+            timestamp=1000.0,
+            tool="line"
+        )
+        
+        data = stroke.to_dict()
+        
+        assert data == asdict(stroke)
+        assert data["points"] is stroke.points
+    
+    def test_models_use_slots(self):
+        """Test model instances carry no per-instance __dict__"""
+        stroke = Stroke(id="x", user_id="u", points=[], color="#000", size=1, layer_id="l", timestamp=0.0)
+        assert not hasattr(stroke, "__dict__")
+        assert not hasattr(Layer(id="l", name="L"), "__dict__")
+        assert not hasattr(Room(id="r", name="R"), "__dict__")
+    
+    def test_stroke_with_multiple_points(self, line_points):
         """Test stroke with multiple drawing points"""
-        points = [{"x": i, "y": i*2} for i in range(100)]
+        points = list(line_points(100))
         stroke = Stroke(
             id="complex_stroke",
             user_id="user_1",
@@ -68,6 +92,28 @@ class TestStrokeModel:
         assert len(stroke.points) == 100
         assert stroke.points[50] == {"x": 50, "y": 100}
 
+    
+    def test_packed_points_round_trip_as_base64(self):
+        """Test packed int16 points are kept as bytes and sent as base64"""
+        packed = struct.pack("<4h", 10, 20, 5, -2)
+        stroke = Stroke(
+            id="packed_stroke",
+            user_id="user_1",
+            points=decode_points(base64.b64encode(packed).decode()),
+            color="#000000",
+            size=3,
+            layer_id="layer_0",
+            timestamp=1000.0
+        )
+        
+        assert stroke.points == packed
+        assert decode_points(stroke.to_dict()["points"]) == packed
+    
+    def test_packed_points_must_be_whole_pairs(self):
+        """Test a packed payload that isn't a whole number of points is rejected"""
+        with pytest.raises(ValueError):
+            decode_points(b"\x01\x00\x02")
+
 
 class TestLayerModel:
     """Test Layer data model"""
@@ -81,6 +127,12 @@ class TestLayerModel:
         assert layer.visible == True
         assert layer.order == 0
     
+    def test_layer_to_dict_matches_asdict(self):
+        """Test the hand-written to_dict agrees with dataclasses.asdict"""
+        layer = Layer(id="layer_1", name="Sketch", opacity=0.5, order=2)
+        
+        assert layer.to_dict() == asdict(layer)
+    
     def test_layer_visibility_toggle(self):
         """Test layer visibility can be set"""
         layer = Layer(id="layer_1", name="Hidden", visible=False)
@@ -111,7 +163,7 @@ class TestRoomModel:
         assert room.id == "test_room"
         assert room.name == "Test Room"
         assert room.layers == []
-        assert room.strokes == []
+        assert len(room.strokes) == 0
         assert room.created_at > 0
     
     def test_room_with_layers(self):
@@ -136,8 +188,21 @@ class TestRoomModel:
             layer_id="l0",
             timestamp=1.0
         )
-        room = Room(id="r1", name="R1", strokes=[stroke])
+        room = Room(id="r1", name="R1", strokes={stroke.id: stroke})
         
         assert len(room.strokes) == 1
-        assert room.strokes[0].id == "s1"
+        assert room.strokes["s1"].id == "s1"
 
+    
+    def test_recent_chat_is_last_messages_in_order(self):
+        """Test recent_chat returns the newest CHAT_REPLAY messages, oldest first"""
+        room = Room(id="r1", name="R1")
+        for i in range(CHAT_REPLAY + 3):
+            room.chat_messages.append(ChatMessage(
+                id=f"m{i}", user_id="u1", nickname="A", text=str(i), timestamp=float(i)
+            ))
+        
+        recent = room.recent_chat()
+        assert len(recent) == CHAT_REPLAY
+        assert recent[0].id == "m3"
+        assert recent[-1].id == f"m{CHAT_REPLAY + 2}"